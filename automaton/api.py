@@ -3,33 +3,23 @@ import os
 import types
 import yaml
 
-from jinja2 import Template
-from subprocess import Popen
+from client import Client
 
 
-#: YAML shell block template, as a jinja2 template
-wrapped = \
-"""
-python - <<-EOF
-import inspect
-import os
-from {{module}} import {{func}}
-spec = inspect.getargspec({{func}})
-if len(spec.args) == 1:
-    {{func}}(os.environ['INPUT'] if 'INPUT' in os.environ else None)
-else:
-    {{func}}()
-EOF
-"""
+#: persistent connection to the automaton socket (opened upon the first transition)
+client = None
 
 def goto(tag, arg=''):
 
     #
-    # - simply popen the usual echo|socat snippet
-    # - this is the only way to proceed since we won't have access to
-    #   the actor (we're in a different process)
+    # - we won't have access to the actor (we're in a different process)
+    # - post the GOTO over our persistent $SOCKET connection without waiting
+    #   for its ack (the transition stays asynchronous)
     #
-    Popen("echo GOTO %s '%s' | socat - $SOCKET" % (tag, arg), close_fds=True, shell=True)
+    global client
+    if client is None:
+        client = Client()
+    client.goto(tag, arg)
 
 
 class State(object):
@@ -53,7 +43,6 @@ class States(object):
         }
 
         global raw
-        from machine import module
         for state in states:
             tag = state.func.__name__
             assert isinstance(state, State), '%s is not deriving from State' % tag
@@ -61,7 +50,7 @@ class States(object):
             js = \
             {
                 'tag': tag,
-                'shell': Template(wrapped).render(func=tag, module=module),
+                'python': tag,
                 'next': state.transitions
             }
             manifest['states'].append(js)
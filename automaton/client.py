@@ -0,0 +1,228 @@
+import os
+import select
+import socket
+
+from threading import Lock
+
+
+class Client(object):
+
+    """
+    Native client for the automaton UNIX socket. One single connection is kept open and
+    switched to the PIPELINE protocol : any number of commands can be written back to back
+    and the replies come back in the same order, one per line.
+
+    Replies to commands sent without waiting (see :meth:`goto`) are drained lazily, before
+    the next command whose reply is needed. The connection is re-opened once if the server
+    went away before a command could be written (a command is never sent twice).
+
+    The server replies in order and only acks a GOTO once the transition starts, which may
+    never happen while the current state runs (e.g a *force* state posting a GOTO and then
+    querying STATE). A command whose reply is needed while posted ones are still not acked
+    is therefore sent over its own one-shot connection, just like socat would do.
+    """
+
+    def __init__(self, path=None):
+
+        self.fd = None
+        self.buf = ''
+        self.lock = Lock()
+        self.path = path or os.environ['SOCKET']
+        self.pending = 0
+
+    def goto(self, tag, arg='', block=False):
+
+        """
+        Requests a transition to the specified state.
+
+        :type tag: str
+        :param tag: target state
+        :type arg: str
+        :param arg: optional payload passed down as $INPUT
+        :type block: bool
+        :param block: if true wait for the server to ack the transition
+        :rtype: str
+        :return: the OK/KO ack if blocking, None otherwise
+        """
+        cmd = 'GOTO %s %s' % (tag, arg) if arg else 'GOTO %s' % tag
+        return self.send(cmd) if block else self.post(cmd)
+
+    def wait(self, tag, arg=''):
+
+        """
+        Requests a transition to the specified state and blocks until its script completes.
+
+        :type tag: str
+        :param tag: target state
+        :type arg: str
+        :param arg: optional payload passed down as $INPUT
+        :rtype: str
+        :return: the OK/KO ack
+        """
+        return self.send('WAIT %s %s' % (tag, arg) if arg else 'WAIT %s' % tag)
+
+    def set(self, key, value):
+
+        """
+        Sets a variable in the environment passed to the state scripts.
+
+        :type key: str
+        :param key: variable name
+        :type value: str
+        :param value: variable value
+        :rtype: str
+        :return: the OK/KO ack
+        """
+        return self.send('SET %s %s' % (key, value))
+
+    def state(self):
+
+        """
+        :rtype: str
+        :return: the current state
+        """
+        return self.send('STATE')
+
+    def post(self, cmd):
+
+        """
+        Writes a command without waiting for its reply.
+
+        :type cmd: str
+        :param cmd: raw command line
+        """
+        with self.lock:
+            self._retry(lambda: self._write(cmd))
+            self.pending += 1
+
+    def send(self, cmd):
+
+        """
+        Writes a command and returns its reply.
+
+        :type cmd: str
+        :param cmd: raw command line
+        :rtype: str
+        :return: the reply, without its trailing newline
+        """
+        with self.lock:
+            if not self._poll():
+                return self._once(cmd)
+
+            self._retry(lambda: self._write(cmd))
+            try:
+                self._drain()
+                return self._readline()
+
+            except (socket.error, EOFError):
+                self._reset()
+                raise
+
+    def close(self):
+        with self.lock:
+            self._reset()
+
+    def _retry(self, op):
+
+        #
+        # - the server may have dropped us (restart) : open a new connection and
+        #   try again once
+        #
+        try:
+            return op()
+
+        except (socket.error, EOFError):
+            self._reset()
+            return op()
+
+    def _connect(self):
+        if self.fd is None:
+            self.fd = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.fd.connect(self.path)
+            self.fd.sendall('PIPELINE\n')
+            self.pending = 1
+
+    def _write(self, cmd):
+
+        #
+        # - a command is one single line : flatten whatever newline is in the payload
+        #
+        self._connect()
+        self.fd.sendall('%s\n' % cmd.replace('\n', ' '))
+
+    def _drain(self):
+
+        #
+        # - skip the replies to whatever we posted before
+        #
+        while self.pending:
+            self._readline()
+            self.pending -= 1
+
+    def _poll(self):
+
+        #
+        # - consume whatever reply to our posted commands already came back, without
+        #   blocking
+        # - return false if some are still pending
+        #
+        try:
+            while self.pending:
+                if '\n' in self.buf:
+                    self._readline()
+                    self.pending -= 1
+                    continue
+
+                readable, _, _ = select.select([self.fd], [], [], 0)
+                if not readable:
+                    return False
+
+                raw = self.fd.recv(4096)
+                if not raw:
+                    raise EOFError('connection closed by the server')
+                self.buf += raw
+
+        except (socket.error, EOFError):
+            self._reset()
+
+        return True
+
+    def _once(self, cmd):
+
+        #
+        # - plain connection carrying one single command : the server closes it once
+        #   replied to (the reply has no trailing newline)
+        #
+        fd = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            fd.connect(self.path)
+            fd.sendall('%s\n' % cmd.replace('\n', ' '))
+            out = ''
+            for raw in iter(lambda: fd.recv(4096), b''):
+                out += raw
+            return out
+
+        finally:
+            fd.close()
+
+    def _readline(self):
+        while '\n' not in self.buf:
+            raw = self.fd.recv(4096)
+            if not raw:
+                raise EOFError('connection closed by the server')
+            self.buf += raw
+
+        line, self.buf = self.buf.split('\n', 1)
+        return line
+
+    def _reset(self):
+        if self.fd is not None:
+            try:
+                self.fd.close()
+
+            except socket.error:
+                pass
+
+        self.fd = None
+        self.buf = ''
+        self.pending = 0
@@ -0,0 +1,331 @@
+import api
+import cPickle
+import importlib
+import inspect
+import logging
+import os
+import signal
+import sys
+import traceback
+
+from kontrol.runner import Job
+from subprocess import Popen, PIPE
+from threading import Lock, Thread
+
+
+#: our ochopod logger
+logger = logging.getLogger('automaton')
+
+
+class Task(Job):
+
+    """
+    State function forked by the :class:`ForkServer`. It mimics the :class:`kontrol.runner.Runner`
+    attributes so that the machine can handle it just like a shell script.
+    """
+
+    def __init__(self, server, on_exit=None):
+        super(Task, self).__init__(server, on_exit=on_exit)
+
+        self.child = None
+        self.signal = None
+
+    def kill(self, sig=signal.SIGTERM):
+
+        #
+        # - kill the forked process group
+        # - if the fork server did not report its pid yet the signal will be sent
+        #   as soon as it does
+        #
+        with self.worker.lock:
+            self.killed = True
+            if self.child is None:
+                self.signal = sig
+                return
+
+        try:
+            os.killpg(self.child, sig)
+
+        except OSError:
+            pass
+
+
+class ForkServer(object):
+
+    """
+    Warm interpreter running the state functions of a python script. A child process
+    holding the imported module forks once per state (which is as fast as it gets), each
+    fork running in its own process group with the specified environment and none of our
+    file descriptors. The machine can therefore still kill a state without impacting the
+    others. Each state is forked as soon as it is submitted, even if the previous one is
+    still exiting, and its output is streamed back line by line.
+
+    The child is a fresh interpreter rather than a fork of the machine (which runs threads
+    and holds the socket). It is lazily (re)started whenever it is not running.
+    """
+
+    def __init__(self, module):
+
+        self.lock = Lock()
+        self.module = module
+        self.next = 0
+        self.pid = None
+        self.tasks = None
+
+    @property
+    def alive(self):
+        return self.pid is not None and self.pid.poll() is None
+
+    def submit(self, func, env, on_exit=None):
+
+        """
+        Forks a new process running the specified state function.
+
+        :type func: str
+        :param func: the function name
+        :type env: dict
+        :param env: environment variables set for the function ($INPUT is passed as argument)
+        :type on_exit: callable
+        :param on_exit: invoked with the task upon completion
+        :rtype: :class:`Task`
+        """
+
+        if not self.alive:
+            self._spawn()
+
+        task = Task(self, on_exit=on_exit)
+        with self.lock:
+            self.next += 1
+            tid = self.next
+            self.tasks[tid] = task
+
+        try:
+            cPickle.dump((tid, func, dict(env)), self.pid.stdin, cPickle.HIGHEST_PROTOCOL)
+            self.pid.stdin.flush()
+
+        except (IOError, ValueError):
+
+            #
+            # - the child died in between, its reader will fail the task
+            #
+            pass
+
+        return task
+
+    def stop(self):
+
+        """
+        Kills the fork server along with whatever state it is running.
+        """
+
+        with self.lock:
+            tasks = list(self.tasks.values()) if self.tasks else []
+
+        for task in tasks:
+            task.kill(signal.SIGKILL)
+
+        if self.alive:
+            try:
+                self.pid.stdin.close()
+                os.kill(self.pid.pid, signal.SIGKILL)
+
+            except (IOError, OSError):
+                pass
+
+    def _spawn(self):
+
+        #
+        # - re-execute the interpreter with our module search path (which includes the
+        #   script directory), in its own session so that it is not hit by our signals
+        # - it imports the module and forks upon requests sent over its stdin
+        # - its stdout is read by a daemon thread
+        # - each child gets its own task table so that it can fail it upon exiting
+        #
+        cmd = [sys.executable, '-c', 'import sys; from automaton.forkserver import _serve; _serve(sys.argv[1])', self.module]
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        self.pid = Popen(cmd,
+        close_fds=True,
+        env=env,
+        preexec_fn=os.setsid,
+        stdin=PIPE,
+        stdout=PIPE)
+
+        self.tasks = {}
+        logger.debug('fork server : started for %s (pid %s)' % (self.module, self.pid.pid))
+        reader = Thread(target=self._read, args=(self.pid, self.tasks))
+        reader.daemon = True
+        reader.start()
+
+    def _read(self, pid, tasks):
+
+        #
+        # - each message is tagged with the id of the task it is for
+        # - each state reports its pid (once it runs in its own process group), then its
+        #   output lines and finally its exit code
+        # - upon EOF the child is gone : reap it and fail whatever task was pending
+        #
+        while 1:
+            try:
+                tid, kind, value = cPickle.load(pid.stdout)
+
+            except (EOFError, IOError, cPickle.UnpicklingError):
+                break
+
+            task = tasks.get(tid)
+            if task is None:
+                continue
+
+            if kind == 'pid':
+                with self.lock:
+                    task.child = value
+
+                logger.debug('fork server : task #%d forked (pid %s)' % (tid, value))
+                if task.signal:
+                    task.kill(task.signal)
+
+            elif kind == 'line':
+                task.stdout.append(value)
+
+            else:
+                with self.lock:
+                    del tasks[tid]
+                task._finish(value)
+
+        pid.stdout.close()
+        code = pid.wait()
+        logger.debug('fork server : pid %s exited (exit %s)' % (pid.pid, code))
+        with self.lock:
+            pending = list(tasks.values())
+            tasks.clear()
+
+        for task in pending:
+            if task.child:
+                task.kill(signal.SIGKILL)
+            task._finish(-1)
+
+
+def _serve(module):
+
+    #
+    # - child process side of the fork server
+    # - keep a private copy of stdout for our messages and point fd 1 to stderr so
+    #   that whatever the module prints can't corrupt them
+    # - import the module once and fork a new process for each state right away
+    # - the output of each fork is relayed by its own thread until it exits
+    #
+    replies = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    lock = Lock()
+
+    def _reply(*msg):
+        with lock:
+            cPickle.dump(msg, replies, cPickle.HIGHEST_PROTOCOL)
+            replies.flush()
+
+    importlib.import_module(module)
+    while 1:
+        try:
+            tid, func, env = cPickle.load(sys.stdin)
+
+        except (EOFError, IOError, cPickle.UnpicklingError):
+            break
+
+        r, w = os.pipe()
+        ready = os.pipe()
+        pid = os.fork()
+        if not pid:
+            _run(module, func, env, w)
+
+        os.close(w)
+        os.close(ready[1])
+        relay = Thread(target=_relay, args=(tid, pid, r, ready[0], _reply))
+        relay.daemon = True
+        relay.start()
+
+
+def _relay(tid, pid, r, ready, reply):
+
+    #
+    # - only report the pid once the fork is in its own process group (it closes
+    #   its end of the ready pipe right after os.setsid()), otherwise signaling the
+    #   group could hit the fork server
+    # - stream the fork output line by line until EOF, then reap it
+    # - mimic the shell exit code upon a signal
+    #
+    os.read(ready, 1)
+    os.close(ready)
+    reply(tid, 'pid', pid)
+    with os.fdopen(r, 'r') as fd:
+        for line in iter(fd.readline, b''):
+            reply(tid, 'line', line.rstrip('\n'))
+
+    _, status = os.waitpid(pid, 0)
+    code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    reply(tid, 'exit', code)
+
+
+def _run(module, func, env, w):
+
+    #
+    # - forked process side : run in our own process group with our output
+    #   redirected to the fork server
+    # - close every other descriptor (the fork server pipes and the ones of the
+    #   other states), just like a subprocess started with close_fds : this also
+    #   closes the ready pipe which signals we are now in our own group
+    # - invoke the function, passing $INPUT if it takes an argument
+    # - make sure we never return into the fork server loop
+    #
+    code = 1
+    try:
+        os.setsid()
+        null = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(null, 0)
+        os.dup2(w, 1)
+        os.dup2(w, 2)
+        _close_fds()
+        os.environ.clear()
+        os.environ.update(env)
+        api.client = None
+
+        fn = getattr(sys.modules[module], func)
+        spec = inspect.getargspec(fn)
+        if len(spec.args) == 1:
+            fn(env['INPUT'] if 'INPUT' in env else None)
+        else:
+            fn()
+        code = 0
+
+    except SystemExit as failure:
+        code = failure.code if isinstance(failure.code, int) else int(failure.code is not None)
+
+    except BaseException:
+        traceback.print_exc()
+
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+        finally:
+            os._exit(code)
+
+
+def _close_fds():
+
+    #
+    # - close whatever is open above stderr, listing /proc when possible rather
+    #   than walking the whole descriptor range
+    #
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+
+    except OSError:
+        fds = range(3, os.sysconf('SC_OPEN_MAX'))
+
+    for fd in fds:
+        if fd > 2:
+            try:
+                os.close(fd)
+
+            except OSError:
+                pass
@@ -10,10 +10,11 @@ import time
 import yaml
 
 from collections import deque
+from forkserver import ForkServer, Task
 from kontrol.fsm import Aborted, diagnostic, FSM, MSG
+from kontrol.runner import Runner
 from os.path import abspath
-from os import getpgid, killpg, path
-from subprocess import Popen, PIPE, STDOUT
+from os import path
 
 
 #: our ochopod logger
@@ -47,6 +48,8 @@ properties:
                     type: string
                 shell:
                     type: string
+                python:
+                    type: string
                 force:
                     type: boolean
                 next:
@@ -64,6 +67,9 @@ class Actor(FSM):
 
     Tripping the machine while its shell script is still running will cause it
     to be killed. Transition requests are buffered and processed in order.
+
+    States defined by a python script are run by a fork server holding the imported
+    module instead of a new interpreter each time.
     """
 
     tag = 'machine'
@@ -125,7 +131,10 @@ class Actor(FSM):
         self.cfg.args = args
         self.env = os.environ
         self.fifo = deque()
+        self.data.runner = None
+        self.forker = ForkServer(module) if module else None
         self.states = {js['tag']:js for js in self.cfg['states']}
+        assert self.forker or not any('python' in js for js in self.cfg['states']), 'python states require a python script'
 
         #
         # - transition to the initial state
@@ -141,6 +150,8 @@ class Actor(FSM):
     def reset(self, data):
        
         if self.terminate:
+            if self.forker:
+                self.forker.stop()
             super(Actor, self).reset(data)
 
         logger.warning('%s uncaught exception -> %s' % (self.where, data.diagnostic))
@@ -177,10 +188,10 @@ class Actor(FSM):
                         #
                         logger.info('%s -> %s' % (self.where, msg.state.upper()))
                         self.cur = self.states[msg.state] 
-                        if 'shell' in self.cur:
+                        if 'shell' in self.cur or 'python' in self.cur:
 
                             #
-                            # - invoke the shell snippet
+                            # - invoke the shell snippet or fork the python function
                             # - then spin and check on its status
                             # - $SOCKET is the absolute filepath of our UNIX socket
                             # - $INPUT is optional and set to whatever was specified in the GOTO
@@ -192,16 +203,16 @@ class Actor(FSM):
                                 'INPUT': msg.extra
                             })
 
-                            data.tick = time.time()
-                            data.pid = Popen(self.cur['shell'],
-                            close_fds=True,
-                            bufsize=0,
-                            shell=True,
-                            env=self.env,
-                            preexec_fn=os.setsid,
-                            stderr=STDOUT,
-                            stdout=PIPE)
-                            logger.debug('%s invoking script (pid %s)' % (self.where, data.pid.pid))
+                            if 'python' in self.cur:
+                                data.runner = self.forker.submit(self.cur['python'], self.env)
+                                logger.debug('%s invoking %s() (fork server pid %s)' % (self.where, self.cur['python'], data.runner.pid.pid))
+
+                            else:
+                                data.runner = Runner(self.cur['shell'],
+                                env=self.env,
+                                shell=True,
+                                merge=True)
+                                logger.debug('%s invoking script (pid %s)' % (self.where, data.runner.pid.pid))
 
                         #
                         # - if we are not blocking send the 'OK' ack immediately
@@ -235,7 +246,7 @@ class Actor(FSM):
         # - check if the subprocess is done or not
         #
         now = time.time()
-        if 'shell' in self.cur:
+        if data.runner:
 
             #
             # - if the force flag is set do not kill the running process if ever
@@ -250,30 +261,30 @@ class Actor(FSM):
             # - if transitions are buffered forcelly terminate the running script
             # - make sure to add a little damper otherwise any shell script that tries to
             #   socat to the machine would kill itself
-            # - display the process standard outputs
+            # - display the process standard outputs (drained as they are produced)
             #
-            complete = data.pid.poll() is not None
+            runner = data.runner
+            complete = runner.complete
             if not force and not complete and len(self.fifo) > 1 and (now - self.fifo[1].tick) > 1.0:
-                logger.debug('%s killing pid %s (fifo -> #%d items)' % (self.where, data.pid.pid, len(self.fifo)))
+                logger.debug('%s killing pid %s (fifo -> #%d items)' % (self.where, _pid(runner), len(self.fifo)))
 
                 #
-                # - use killpg to kill the whole sub-progress group
+                # - kill the whole sub-progress group
                 # - simply using the popen kill() method won't work
                 #
-                killpg(getpgid(data.pid.pid), signal.SIGTERM)
+                runner.kill(signal.SIGTERM)
                 complete = True
 
             if complete:
-                lapse = now - data.tick
-                code = data.pid.returncode
-                stdout = [line.rstrip('\n') for line in iter(data.pid.stdout.readline, b'')]
-                logger.debug('%s pid %s took %2.1f s (exit %s)' % (self.where, data.pid.pid, lapse, code if code is not None else '_'))
-                if stdout:
-                    logger.debug('%s \n  . %s' % (self.where, '\n  . '.join(stdout)))
+                lapse = now - runner.tick
+                code = runner.code
+                logger.debug('%s pid %s took %2.1f s (exit %s)' % (self.where, _pid(runner), lapse, code if code is not None else '_'))
+                if runner.stdout:
+                    logger.debug('%s \n  . %s' % (self.where, '\n  . '.join(runner.stdout)))
         else:
 
             #
-            # - there was no shell invokation
+            # - there was no shell or python invokation
             # - set the complete trigger on
             #
             complete = True
@@ -288,7 +299,7 @@ class Actor(FSM):
             if msg.wait:
                 self._ack(msg, 'OK')
 
-            data.pid = None
+            data.runner = None
             self.fifo.popleft()
             return 'initial', data, 0
         
@@ -325,9 +336,11 @@ class Actor(FSM):
                     #
                     # - set the specified key/value pair onto the environment dict
                     #   used when invoking the shell script
+                    # - ack right away
                     #
                     self.env[tokens[1]] = ' '.join(tokens[2:])
-                
+                    self._ack(msg, 'OK')
+
                 elif tokens[0] in ['GOTO', 'WAIT']:
 
                     #
@@ -356,3 +369,15 @@ class Actor(FSM):
             except IOError:
                 pass
                 
+
+
+def _pid(runner):
+
+    #
+    # - python states report the pid of their fork rather than the fork server one
+    # - the fork may not have reported it yet
+    #
+    if isinstance(runner, Task):
+        return runner.child if runner.child else '?'
+
+    return runner.pid.pid
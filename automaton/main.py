@@ -12,6 +12,7 @@ from logging.config import fileConfig
 from logging.handlers import RotatingFileHandler
 from os.path import exists, dirname
 from machine import Actor as Machine
+from server import Server
 
 
 #
@@ -71,29 +72,24 @@ def go():
             #
             global actor
             actor = Machine.start(args)
-            while True:
+
+            def _dispatch(cnx, line):
 
                 #
-                # - read/buffer
-                # - forward to the actor
+                # - forward each command to the actor
                 # - pass down the connection object in case we need to
                 #   write back to the socket
                 #
-                buf = ''
-                cnx, addr = fd.accept()
-                while True: 
-
-                    raw = cnx.recv(1024)
-                    if not raw:
-                        break
-                    buf += raw
-
-                snippet = buf.rstrip('\n')
-                logger.debug('socket -> "%s"' % snippet)
-                msg = MSG({'request': 'cmd', 'raw': buf.rstrip('\n')})
+                msg = MSG({'request': 'cmd', 'raw': line})
                 msg.cnx = cnx
                 actor.tell(msg)
 
+            #
+            # - serve all the clients at once from this thread
+            # - a slow client cannot block the others
+            #
+            Server(fd, _dispatch).run()
+
         finally:
             if actor:
                 msg = MSG({'request': 'cmd', 'raw': 'DIE'})
@@ -0,0 +1,244 @@
+import errno
+import logging
+import os
+import select
+import socket
+import time
+
+from collections import deque
+from threading import Lock
+
+
+#: Our automaton logger.
+logger = logging.getLogger('automaton')
+
+
+class Slot(object):
+
+    """
+    Placeholder for the reply to one command. Replies may be sent from any thread and are
+    flushed by the server once the slot is closed.
+    """
+
+    def __init__(self, cnx, out=None):
+
+        self.cnx = cnx
+        self.done = out is not None
+        self.out = out or ''
+
+    def send(self, data):
+        with self.cnx.server.lock:
+            self.out += data
+
+    def close(self):
+        with self.cnx.server.lock:
+            self.done = True
+        self.cnx.server.wake()
+
+
+class Connection(object):
+
+    """
+    Client connection tracked by the server. Incoming data is buffered until a full command
+    is received. By default the connection carries one single command and is closed once it
+    is replied to. If the client starts with PIPELINE the connection remains open and any
+    number of commands can be sent, each reply being terminated by a newline. Pipelined
+    commands are queued and run one after the other : the next one is only dispatched once
+    the previous one was replied to, which keeps the replies in order.
+    """
+
+    def __init__(self, server, fd):
+
+        self.buf = ''
+        self.eof = False
+        self.fd = fd
+        self.out = ''
+        self.pipelined = False
+        self.queue = deque()
+        self.server = server
+        self.slots = deque()
+        self.tick = time.time()
+        self.used = False
+
+    @property
+    def reading(self):
+        return not self.eof and (self.pipelined or not self.used)
+
+    @property
+    def idle(self):
+
+        #
+        # - a connection is only timed out while waiting for a (partial) command
+        # - pipelined connections may remain open without sending anything
+        #
+        return self.reading and (self.buf or not self.pipelined)
+
+
+class Server(object):
+
+    """
+    Multiplexed UNIX socket server serving any number of clients at once from a single
+    thread. Each command is a single line and is dispatched as soon as its newline (or the
+    client EOF) is received. Connections that do not send a full command within the read
+    timeout are dropped.
+    """
+
+    def __init__(self, fd, dispatch, timeout=10.0):
+
+        self.cnxs = {}
+        self.dispatch = dispatch
+        self.fd = fd
+        self.lock = Lock()
+        self.pipe = os.pipe()
+        self.timeout = timeout
+
+    def wake(self):
+        try:
+            os.write(self.pipe[1], 'x')
+
+        except OSError:
+            pass
+
+    def run(self):
+
+        self.fd.setblocking(0)
+        while True:
+
+            #
+            # - move whatever reply is ready to the output buffers
+            # - wait for new connections, incoming data, pending replies or a wake-up
+            # - use a short timeout to enforce the read timeouts
+            #
+            for cnx in self.cnxs.values():
+                self._collect(cnx)
+
+            readers = [self.fd, self.pipe[0]] + [cnx.fd for cnx in self.cnxs.values() if cnx.reading]
+            writers = [cnx.fd for cnx in self.cnxs.values() if cnx.out]
+            try:
+                readable, writable, _ = select.select(readers, writers, [], 1.0)
+
+            except select.error as failure:
+                if failure.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd in readable:
+                if fd is self.fd:
+                    self._accept()
+                elif fd == self.pipe[0]:
+                    os.read(self.pipe[0], 4096)
+                elif fd in self.cnxs:
+                    self._read(self.cnxs[fd])
+
+            for fd in writable:
+                if fd in self.cnxs:
+                    self._write(self.cnxs[fd])
+
+            #
+            # - drop whoever did not send a full command in time
+            #
+            now = time.time()
+            for cnx in [cnx for cnx in self.cnxs.values() if cnx.idle and now - cnx.tick > self.timeout]:
+                logger.debug('socket : dropping idle connection')
+                self._drop(cnx)
+
+    def _accept(self):
+        try:
+            fd, _ = self.fd.accept()
+            fd.setblocking(0)
+            self.cnxs[fd] = Connection(self, fd)
+
+        except socket.error as failure:
+            if failure.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _read(self, cnx):
+        try:
+            raw = cnx.fd.recv(4096)
+
+        except socket.error as failure:
+            if failure.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raw = ''
+
+        #
+        # - queue the commands as soon as we have full lines
+        # - a client closing its end without a trailing newline is fine too
+        # - the PIPELINE switch is acked right away
+        #
+        cnx.tick = time.time()
+        cnx.buf += raw
+        lines = cnx.buf.split('\n')
+        cnx.buf = lines.pop() if raw else ''
+        for line in [line.rstrip('\r') for line in lines if line.strip()]:
+            if not cnx.reading:
+                break
+
+            cnx.used = True
+            if line == 'PIPELINE' and not cnx.pipelined:
+                cnx.pipelined = True
+                cnx.slots.append(Slot(cnx, 'OK'))
+            else:
+                cnx.queue.append(line)
+
+        cnx.eof = not raw
+        self._pump(cnx)
+
+        #
+        # - the client is gone and nothing is pending : drop the connection
+        #
+        if cnx.eof and not cnx.queue and not cnx.slots and not cnx.out:
+            self._drop(cnx)
+
+    def _pump(self, cnx):
+
+        #
+        # - dispatch the next queued command with its reply slot, provided the
+        #   previous one was replied to
+        #
+        while cnx.queue and all(slot.done for slot in cnx.slots):
+            line = cnx.queue.popleft()
+            slot = Slot(cnx)
+            cnx.slots.append(slot)
+            logger.debug('socket -> "%s"' % line)
+            self.dispatch(slot, line)
+
+    def _collect(self, cnx):
+
+        #
+        # - flush the completed replies in order, stopping at the first pending one
+        # - pipelined replies are newline terminated
+        #
+        with self.lock:
+            while cnx.slots and cnx.slots[0].done:
+                slot = cnx.slots.popleft()
+                cnx.out += '%s\n' % slot.out if cnx.pipelined else slot.out
+
+        self._pump(cnx)
+
+        #
+        # - a connection carrying one single command is closed once replied to, just
+        #   like a pipelined one whose client is gone
+        #
+        if not cnx.out and not cnx.queue and not cnx.slots and (cnx.eof or (cnx.used and not cnx.pipelined)):
+            self._drop(cnx)
+
+    def _write(self, cnx):
+        try:
+            sent = cnx.fd.send(cnx.out)
+            cnx.out = cnx.out[sent:]
+
+        except socket.error as failure:
+            if failure.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._drop(cnx)
+                return
+
+        self._collect(cnx)
+
+    def _drop(self, cnx):
+        self.cnxs.pop(cnx.fd, None)
+        try:
+            cnx.fd.close()
+
+        except socket.error:
+            pass
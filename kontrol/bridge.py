@@ -0,0 +1,157 @@
+import gevent
+import logging
+import time
+
+from collections import deque
+from gevent.event import AsyncResult, Event
+from threading import Semaphore
+
+
+#: our ochopod logger
+logger = logging.getLogger('kontrol')
+
+
+def _watcher(hub):
+
+    #
+    # - gevent 1.3+ renamed loop.async() to loop.async_()
+    #
+    loop = hub.loop
+    factory = getattr(loop, 'async_', None) or getattr(loop, 'async')
+    return factory()
+
+
+class Latch(object):
+
+    """
+    Latch set from any actor thread and waited upon from a greenlet. Unlike a pykka
+    :class:`pykka.ThreadingFuture` waiting on it yields to the gevent hub : the value is
+    handed over through an async watcher which wakes the hub up from the setting thread.
+
+    Please note the latch must be created from within the hub thread.
+    """
+
+    def __init__(self):
+
+        self.result = AsyncResult()
+        self.value = None
+        self.watcher = _watcher(gevent.get_hub())
+        self.watcher.start(self._wakeup)
+
+    def set(self, value=None):
+
+        #
+        # - thread-safe : stash the value and wake the hub up
+        # - the greenlet blocked in get() will be resumed from the hub thread
+        #
+        self.value = value
+        self.watcher.send()
+
+    def get(self, timeout=None):
+
+        """
+        Blocks the current greenlet until the latch is set.
+
+        :type timeout: float
+        :param timeout: optional timeout in seconds
+        :rtype: whatever value the latch was set with
+        :raises: :class:`gevent.Timeout` upon timeout
+        """
+        try:
+            return self.result.get(timeout=timeout)
+
+        finally:
+            self.watcher.stop()
+
+    def _wakeup(self):
+        self.result.set(self.value)
+
+
+class Stream(object):
+
+    """
+    Bounded line channel fed from an actor thread and drained by a greenlet. The producer
+    blocks as soon as *depth* lines are pending, which in turn applies backpressure on
+    whatever it is reading from (typically a subprocess pipe). The consumer iterates over
+    drain() without blocking the gevent hub.
+
+    Please note the stream must be created from within the hub thread.
+    """
+
+    def __init__(self, depth=64):
+
+        self.closed = False
+        self.credits = Semaphore(depth)
+        self.depth = depth
+        self.lines = deque()
+        self.ready = Event()
+        self.watcher = _watcher(gevent.get_hub())
+        self.watcher.start(self.ready.set)
+
+    def put(self, line):
+
+        #
+        # - thread-safe : block until the consumer catches up
+        # - silently drop the line if the consumer went away
+        #
+        if self.closed:
+            return
+
+        self.credits.acquire()
+        self.lines.append(line)
+        self.watcher.send()
+
+    def end(self, failure=None):
+
+        #
+        # - thread-safe : mark the end of the stream
+        # - if a failure is specified it is raised to the consumer once it drained
+        #   whatever lines came before
+        # - this never blocks
+        #
+        self.lines.append(failure)
+        self.watcher.send()
+
+    def drain(self, timeout=None):
+
+        """
+        Generator yielding the lines as they are produced, until end() is invoked.
+
+        :type timeout: float
+        :param timeout: optional overall timeout in seconds
+        :rtype: generator
+        :raises: :class:`gevent.Timeout` upon timeout, or whatever failure end() was invoked with
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        try:
+            while 1:
+                self.ready.clear()
+                while self.lines:
+                    line = self.lines.popleft()
+                    if line is None:
+                        return
+
+                    if isinstance(line, Exception):
+                        raise line
+
+                    self.credits.release()
+                    yield line
+
+                #
+                # - wait for the producer to wake us up
+                # - enforce the overall timeout if any
+                #
+                lapse = deadline - time.time() if deadline is not None else None
+                if (lapse is not None and lapse <= 0) or not self.ready.wait(lapse):
+                    raise gevent.Timeout(timeout)
+
+        finally:
+
+            #
+            # - the consumer is gone (or done)
+            # - unblock the producer in case it is waiting on credits
+            #
+            self.closed = True
+            self.watcher.stop()
+            for _ in range(self.depth):
+                self.credits.release()
@@ -1,20 +1,28 @@
-import etcd
 import json
 import logging
 import os
+import re
 import time
-import statsd
 
-from collections import deque
-from etcd import EtcdKeyNotFound
+from kontrol import metrics, store
+from kontrol.store import IndexCleared, KeyNotFound, WatchTimedOut
 from kontrol.fsm import Aborted, FSM
-from subprocess import Popen, PIPE, STDOUT
+from kontrol.runner import Plugin, Runner, Worker
 from threading import Thread
 
 
 #: our ochopod logger
 logger = logging.getLogger('kontrol')
 
+#: maximum delay in seconds before retrying a callback that failed
+BACKOFF = 60
+
+#: maximum number of retries for a callback that keeps failing on the same snapshot
+RETRIES = 5
+
+#: python entry point syntax for the callback (e.g some.module:function)
+ENTRY = re.compile(r'^[\w.]+:\w+$')
+
 
 class Actor(FSM):
 
@@ -25,6 +33,27 @@ class Actor(FSM):
 
     The subprocess invoked via POpen will be interpreted as a shell script if $KONTROL_SHELL_CALLBACK
     is defined and set to TRUE.
+
+    Only the latest request matters : it is kept in a single pending slot and replaces whatever
+    was there. If $KONTROL_PREEMPT_CALLBACK is defined and set to TRUE a running callback is killed
+    as soon as a request for a different MD5 digest comes in, otherwise it is allowed to finish.
+
+    If $KONTROL_WORKER_CALLBACK is defined and set to TRUE the callback is started once and kept
+    running. Each request is then written to its stdin as a single json line (with the MD5, PODS
+    and STATE fields) and the worker must reply with a single line holding the new state. The
+    worker is restarted if it crashes or is killed.
+
+    $KONTROL_CALLBACK may also be a python entry point such as *my.module:function*. The function is
+    then run in a dedicated child process and invoked with the MD5, PODS and STATE keyword arguments
+    as native objects. Whatever it returns is serialized to json and persisted as the new state.
+
+    The last state is cached in memory and kept coherent by watching its etcd key. It is only
+    written back when the callback output actually differs.
+
+    If $KONTROL_CALLBACK_TIMEOUT is set the callback (and all its children) is killed after that
+    many seconds. A callback that timed out or failed without replying is retried with an
+    exponential backoff unless a newer request comes in meanwhile. After RETRIES attempts the
+    snapshot is given up on and the failure is reported in our status until a run succeeds.
     """
 
     tag = 'callback'
@@ -33,37 +62,67 @@ class Actor(FSM):
         super(Actor, self).__init__()
 
         self.cfg = cfg
-        self.client = etcd.Client(host=cfg['etcd'], port=2379)
-        self.fifo = deque()
+        self.client = store.connect(cfg)
         self.path = '%s actor' % self.tag
+        self.pending = None
+        self.preempt = 'KONTROL_PREEMPT_CALLBACK' in os.environ and os.environ['KONTROL_PREEMPT_CALLBACK'] == 'TRUE'
         self.shell = 'KONTROL_SHELL_CALLBACK' in os.environ and os.environ['KONTROL_SHELL_CALLBACK'] == 'TRUE'
-        self.statsd = statsd.StatsClient('127.0.0.1', 8125)
+        self.persistent = 'KONTROL_WORKER_CALLBACK' in os.environ and os.environ['KONTROL_WORKER_CALLBACK'] == 'TRUE'
+        self.plugin = ENTRY.match(cfg['callback']) is not None if 'callback' in cfg else False
+        self.worker = None
         
+        #
+        # - last known (value, modified index) tuple for <prefix>/state, None if unknown
+        # - the watch uses its own client as it blocks for long periods of time
+        #
+        self.cached = None
+        self.follower = store.connect(cfg, watch=True)
+        self.timeout = float(cfg['callback_timeout']) if 'callback_timeout' in cfg else None
         self.data.left = None
+        self.data.msg = None
+        self.data.runner = None
+        self.status.update({'failed': None, 'last': None, 'pending': None, 'running': None})
+
+    def on_start(self):
+
+        follow = Thread(target=self._follow)
+        follow.daemon = True
+        follow.start()
+        super(Actor, self).on_start()
 
     def reset(self, data):
 
+        #
+        # - if we failed while completing a callback run make sure it gets retried
+        #   unless a newer request came in
+        #
+        if data.msg and not self.pending:
+            self.pending = data.msg
+
+        data.msg = None
+        data.runner = None
         if self.terminate:
+            if self.worker:
+                self.worker.stop()
             super(Actor, self).reset(data)
 
         return 'initial', data, 0.0
 
     def initial(self, data):
                 
-        if self.terminate and not self.fifo:
+        if self.terminate and not self.pending:
             raise Aborted('resetting')
 
         #
         # - just spin if there is nothing to invoke
-        # - if we have buffered 1+ requests just peek at the latest one
-        #   and cycle back if its ttl has not been exceeded (e.g it's too
-        #   early to execute the script)
+        # - otherwise peek at the pending request and cycle back if its ttl
+        #   has not been exceeded (e.g it's too early to execute the script)
         #
         now = time.time()
-        if not self.fifo:
+        if not self.pending:
             return 'initial', data, 0.25
             
-        lapse = self.fifo[-1].ttl - now
+        lapse = self.pending.ttl - now
         if lapse > 0:
             left = int(lapse)
             if left != data.left:
@@ -74,97 +133,226 @@ class Actor(FSM):
 
         #
         # - it's time to run the script
-        # - consider the latest request we received
+        # - take the pending request out of its slot
         #
         data.left = None
-        msg = self.fifo[-1]
-        try:
-            raw = self.client.read('%s/state' % self.cfg['prefix']).value
-            if raw:
-                msg.env['STATE'] = raw
-        except EtcdKeyNotFound:
-            pass
+        msg = self.pending
+        self.pending = None
+        raw = self._state()
+        if raw:
+            msg.env['STATE'] = raw
 
         #
-        # - override with the current environment
-        # - spawn the subprocess
+        # - either hand the request over to our plugin or persistent worker or spawn the
+        #   subprocess with the current environment on top of the request one
+        # - the outputs are drained as they are produced
+        # - we'll be tripped to wait_for_completion() as soon as it replies or exits
         #
-        msg.env.update(os.environ)
+        completed = lambda _: self.fire({'fsm': {'state': 'wait_for_completion', 'data': data}})
         try:
-            data.tick = now
-            data.pid = Popen(msg.cmd.split(' '),
-            shell=self.shell,
-            close_fds=True,
-            bufsize=0,
-            env=msg.env,
-            stderr=PIPE,
-            stdout=PIPE)
+            if self.plugin or self.persistent:
+                if not self.worker:
+                    self.worker = Plugin(msg.cmd) if self.plugin else Worker(msg.cmd.split(' '), env=dict(os.environ), shell=self.shell)
+
+                #
+                # - the state is passed as is if it can't be parsed as json
+                #
+                state = msg.env['STATE'] if 'STATE' in msg.env else None
+                try:
+                    state = json.loads(state) if state else None
+                except ValueError:
+                    pass
+
+                request = \
+                {
+                    'MD5': msg.env['MD5'],
+                    'PODS': msg.pods,
+                    'STATE': state
+                }
+                data.runner = self.worker.submit(request, timeout=self.timeout, on_exit=completed)
+
+            else:
+                msg.env.update(os.environ)
+                data.runner = Runner(msg.cmd.split(' '), env=msg.env, shell=self.shell, timeout=self.timeout, on_exit=completed)
     
         except OSError:
             logger.warning('%s : script "%s" could not be found (config bug ?)' % (self.path, msg.cmd))   
-            self.fifo.popleft()
             return 'initial', data, 0.0
 
-        self.statsd.incr('callback_invoked,tier=kontrol')
-        logger.debug('%s : invoking script "%s" (pid %s)' % (self.path, msg.cmd, data.pid.pid))
-        return 'wait_for_completion', data, 0.25
+        data.msg = msg
+        self.status.update({'pending': None, 'running': msg.env['MD5']})
+        metrics.incr('callback_invoked,tier=kontrol')
+        logger.debug('%s : invoking script "%s" (pid %s)' % (self.path, msg.cmd, data.runner.pid.pid))
+        return None
 
     def wait_for_completion(self, data):
 
         #
-        # - stop spinning once the process has exited
-        # - both stderr and stdout are piped
+        # - the process exited and both its stderr and stdout are drained
         #
-        if data.pid.poll() is not None:
-            code = data.pid.returncode
-            stdout = [line.rstrip('\n') for line in iter(data.pid.stdout.readline, b'')]
-            stderr = [line.rstrip('\n') for line in iter(data.pid.stderr.readline, b'')]
-            lapse = time.time() - data.tick
-            logger.info('%s: callback took %2.1f s (pid %s, exit %d)' % (self.path, lapse, data.pid.pid, code))
-            if stderr:
-                logger.debug('%s : stderr (pid %s) -> \n  . %s' % (self.path, data.pid.pid, '\n  . '.join(stderr)))
-            
+        runner = data.runner
+        self.status['last'] = runner.lapse
+        logger.info('%s: callback took %2.1f s (pid %s, exit %d)' % (self.path, runner.lapse, runner.pid.pid, runner.code))
+        metrics.timing('callback_duration,tier=kontrol', runner.lapse * 1000)
+        if runner.stderr:
+            logger.debug('%s : stderr (pid %s) -> \n  . %s' % (self.path, runner.pid.pid, '\n  . '.join(runner.stderr)))
+        
+        if runner.timed_out:
+            metrics.incr('callback_timeout,tier=kontrol')
+        elif runner.code and not runner.killed:
+            metrics.incr('callback_failed,tier=kontrol')
+
+        #
+        # - persist stdout as our new state
+        # - skip if we killed the callback, its output is partial and was meant for
+        #   a stale snapshot anyway
+        # - if it timed out or failed without replying leave the state untouched and
+        #   retry later on unless a newer request is pending
+        # - a callback failing deterministically would otherwise loop forever : give up
+        #   after a few attempts and record the failure in our status (the next snapshot
+        #   will run it again)
+        #
+        if runner.timed_out or (self.worker and runner.code and not runner.killed):
+            msg = data.msg
+            msg.retries = getattr(msg, 'retries', 0) + 1
+            lapse = min(BACKOFF, 2 ** msg.retries)
+            if self.pending:
+                logger.warning('%s : callback failed, superseded by a newer request' % self.path)
+            elif msg.retries > RETRIES:
+                logger.warning('%s : callback failed %d times for %s, giving up' % (self.path, msg.retries, msg.env['MD5']))
+                metrics.incr('callback_abandoned,tier=kontrol')
+                self.status['failed'] = \
+                {
+                    'code': runner.code,
+                    'md5': msg.env['MD5'],
+                    'retries': RETRIES,
+                    'timed_out': runner.timed_out
+                }
+            else:
+                logger.warning('%s : callback failed, retrying in %d seconds (attempt #%d)' % (self.path, lapse, msg.retries))
+                msg.ttl = time.time() + lapse
+                self.pending = msg
+                self.status['pending'] = msg.env['MD5']
+
+        elif runner.killed:
+            logger.debug('%s : callback preempted, discarding its output' % self.path)
+
+        else:
+            if self.pending:
+                metrics.incr('callback_stale,tier=kontrol')
+
             #
-            # - attempt to parse stdout into a json object
+            # - only write if the state actually changed
             #
-            try:
-                self.client.write('%s/state' % self.cfg['prefix'], ''.join(stdout))
-            except ValueError:
-                logger.warning('%s : unable to parse stdout into json (script error ?)' % self.path)
+            out = ''.join(runner.stdout)
+            if out == self._state():
+                metrics.incr('state_unchanged,tier=kontrol')
+            else:
+                res = self.client.write('%s/state' % self.cfg['prefix'], out)
+                self.cached = (res.value, res.modified)
 
             #
-            # - cleanup the FIFO (e.g drop all buffered requests)
-            # - go back to the initial state
+            # - record the digest we just applied next to the state
+            # - the leader uses it to skip re-running the callback upon fail-over
+            # - a subprocess that exited with an error did not apply it : leave the
+            #   digest as is so that the next leader runs it again
             #
-            data.pid = None
-            self.fifo.clear()
-            return 'initial', data, 0
+            if runner.code == 0:
+                self.client.write('%s/digest' % self.cfg['prefix'], data.msg.env['MD5'])
+                self.status['failed'] = None
 
-        return 'wait_for_completion', data, 0.25
+        #
+        # - go back to the initial state
+        # - the pending slot may already hold the next request
+        #
+        data.msg = None
+        data.runner = None
+        self.status['running'] = None
+        return 'initial', data, 0
     
 
+    def _state(self):
+
+        #
+        # - return the cached state, reading it if we don't know it yet
+        #
+        if self.cached is None:
+            try:
+                res = self.client.read('%s/state' % self.cfg['prefix'])
+                self.cached = (res.value, res.modified)
+
+            except KeyNotFound as failure:
+                self.cached = (None, failure.index)
+
+        return self.cached[0]
+
+    def _follow(self):
+
+        #
+        # - watch <prefix>/state and update our cache whenever it changes (for instance if
+        #   another master wrote to it)
+        # - resume from the last index we know of so that no update is missed
+        # - if we fell too much behind (e.g the state did not change while plenty of
+        #   other keys did) that index is gone for good : read the state again and
+        #   watch from now on until the next update, otherwise we would spin
+        #
+        key = '%s/state' % self.cfg['prefix']
+        resume = True
+        while not self.terminate:
+            try:
+                if self.cached is None:
+                    self._state()
+
+                index = self.cached[1] if resume else None
+                res = self.follower.watch(key, index=index + 1 if index else None, timeout=30)
+                self.cached = (None if res.action in ('delete', 'expire') else res.value, res.modified)
+                resume = True
+
+            except WatchTimedOut:
+                pass
+
+            except IndexCleared:
+                self.cached = None
+                resume = False
+
+            except Exception as failure:
+                logger.debug('%s : unable to watch %s (%s)' % (self.path, key, failure))
+                self.cached = None
+                time.sleep(1.0)
+
     def specialized(self, msg):
         assert 'request' in msg, 'bogus message received ?'
         req = msg['request']
         if req == 'invoke':
 
             #
-            # - buffer the incoming script in our fifo
-            # - we'll dequeue it upon the next spin
+            # - latest wins : replace whatever request is pending
+            # - we'll run it upon the next spin
             #
-            self.fifo.append(msg)
+            if self.pending:
+                metrics.incr('callback_superseded,tier=kontrol')
+                logger.debug('%s : pending callback for %s superseded' % (self.path, self.pending.env['MD5']))
+
+            self.pending = msg
+            self.status['pending'] = msg.env['MD5']
+
+            #
+            # - if a callback is running for a different digest it is already stale
+            # - kill it if we are allowed to (its completion will be discarded)
+            #
+            running = self.data.msg
+            if self.preempt and running and self.data.runner and running.env['MD5'] != msg.env['MD5']:
+                logger.debug('%s : preempting callback for %s' % (self.path, running.env['MD5']))
+                metrics.incr('callback_preempted,tier=kontrol')
+                self.data.runner.kill()
 
         elif req == 'state':
 
             #
             # - request from GET /state
-            # - simply read the state from etcd and return it
+            # - serve it from our cache
             #
-            try:
-                return self.client.read('%s/state' % self.cfg['prefix']).value
-
-            except EtcdKeyNotFound:
-                pass
+            return self._state()
        
         else:
             super(Actor, self).specialized(msg)
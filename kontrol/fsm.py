@@ -12,6 +12,9 @@ from threading import Event, Thread
 #: our pycse logger
 logger = logging.getLogger('kontrol')
 
+#: per-actor status dicts keyed by actor urn (updated by each actor, readable from any thread)
+statuses = {}
+
 """
     Basic Pykka based finite state-machine implementation.
 """
@@ -200,6 +203,13 @@ class FSM(ThreadingActor):
         self.last_reset = time.time()
         self.damper = 0
 
+        #
+        # - publish our status dict so that it can be introspected
+        # - subclasses are free to add their own fields
+        #
+        self.status = {'state': None}
+        statuses[self.actor_urn] = self.status
+
     def exitcode(self, code=None):
 
         #
@@ -320,6 +330,7 @@ class FSM(ThreadingActor):
                     #
                     pass
                 else:
+                    self.status['state'] = cmd['state']
                     func = getattr(self, cmd['state'], None)
                     assert func, '<' + cmd['state'] + '> does not exist'
                     assert callable(func), '<' + cmd['state'] + '> must be a callable'
@@ -1,15 +1,18 @@
+import hashlib
 import json
 import logging
 import os
 import string
 import struct
 import time
-import statsd
 
+from kontrol import metrics
 from kontrol.fsm import Aborted, FSM, MSG
 from kontrol.main import outgoing
+from kontrol.watch import Watcher
 from math import floor
 from os.path import isfile
+from random import uniform
 from socket import inet_aton
 
 
@@ -17,36 +20,225 @@ from socket import inet_aton
 logger = logging.getLogger('kontrol')
 
 
+def assemble(cfg, key, nonce, payload, down=False):
+
+    """
+    Assembles the pod record reported to the masters along with the heartbeat sent
+    instead as long as the record does not change.
+
+    :type cfg: dict
+    :param cfg: kontrol configuration
+    :type key: str
+    :param key: the pod key
+    :type nonce: str
+    :param nonce: random nonce identifying this incarnation of the pod
+    :type payload: dict
+    :param payload: user payload
+    :type down: bool
+    :param down: if true set the down trigger
+    :rtype: (dict, dict) tuple
+    """
+
+    js = \
+    {
+        'app': cfg['labels']['app'],
+        'id': cfg['id'],
+        'ip': cfg['ip'],
+        'key': key,
+        'nonce': nonce,
+        'payload': payload,
+        'role': cfg['labels']['role']
+    }
+
+    if down:
+        js['down'] = True
+
+    #
+    # - hash the record and include the hash in it
+    # - the heartbeat only carries the pod key, nonce and hash
+    #
+    digest = hashlib.md5(json.dumps(js, sort_keys=True)).hexdigest()
+    js['hash'] = digest
+    return js, {'hash': digest, 'key': key, 'nonce': nonce}
+
+
+def period(ttl):
+
+    #
+    # - the nominal ping period is TTL * 0.75 which leaves room for one more
+    #   attempt before the pod record expires : this is never exceeded
+    # - randomize it below that bound by up to 15% so that pods started (or failed
+    #   over) at the same time do not remain in lockstep
+    #
+    return ttl * 0.75 * uniform(0.85, 1.0)
+
+
+def track(host, ttl, now):
+
+    """
+    Creates the keepalive schedule for one target. The first ping is spread uniformly over the
+    regular period so that pods started at the same time (e.g a whole deployment) do not hit the
+    masters all at once, assuming we have a full TTL to reach the target to begin with.
+
+    :type host: str
+    :param host: the target master
+    :type ttl: int
+    :param ttl: pod record TTL in seconds
+    :type now: float
+    :param now: current time
+    :rtype: :class:`kontrol.fsm.MSG`
+    """
+
+    target = MSG()
+    target.acked = None
+    target.damper = 0
+    target.deadline = now + ttl
+    target.host = host
+    target.load = 0.0
+    target.next = now + uniform(0, ttl * 0.75)
+    return target
+
+
+def due(target, ttl, digest, now, force=False):
+
+    """
+    Checks whether a keepalive is due for the target and schedules the next one if so. A heartbeat
+    (the target acknowledged this record already) is held off past the regular period if the target
+    reports load, as long as the pod record has enough time left : the margin kept before it expires
+    shrinks from 25% of the TTL down to 10% when fully loaded, which is enough for one RPC.
+
+    :type target: :class:`kontrol.fsm.MSG`
+    :param target: the target schedule
+    :type ttl: int
+    :param ttl: pod record TTL in seconds
+    :type digest: str
+    :param digest: hash of the current pod record
+    :type now: float
+    :param now: current time
+    :type force: bool
+    :param force: if true the keepalive is sent right away
+    :rtype: bool
+    """
+
+    if not force:
+        if now <= target.next:
+            return False
+
+        hold = target.deadline - ttl * (0.25 - 0.15 * target.load)
+        if target.acked == digest and target.load and now < hold:
+            target.next = hold
+            return False
+
+    target.next = now + period(ttl)
+    return True
+
+
+def acknowledged(target, ttl, digest, reply, tick):
+
+    """
+    Updates the target schedule once it acknowledged a keepalive. The pod record is good until the
+    ping time + TTL. The backoff is reset and the load hint returned by the target tracked. The record
+    hash is remembered unless the target did not reply anything (older master not supporting heartbeats)
+    or asked for the full record, in which case it is due right away.
+
+    :type target: :class:`kontrol.fsm.MSG`
+    :param target: the target schedule
+    :type ttl: int
+    :param ttl: pod record TTL in seconds
+    :type digest: str
+    :param digest: hash of the pod record that was sent
+    :type reply: dict
+    :param reply: whatever the target replied, if anything
+    :type tick: float
+    :param tick: time the keepalive was sent at
+    :rtype: bool (true if the full record was requested)
+    """
+
+    target.acked = None
+    target.damper = 0
+    target.deadline = tick + ttl
+    target.load = min(1.0, max(0.0, float(reply.get('load', 0.0)))) if reply else 0.0
+    if reply is not None and reply.get('resend'):
+        target.next = 0
+        return True
+
+    if reply is not None:
+        target.acked = digest
+
+    return False
+
+
+def failed(target, ttl, now):
+
+    """
+    Reschedules the target once a keepalive failed. It is retried sooner with an exponential backoff
+    plus a bit of randomization but never later than half the time left before the pod record expires
+    so that we get a few more attempts in. Once it expired we keep backing off up to the regular period.
+
+    :type target: :class:`kontrol.fsm.MSG`
+    :param target: the target schedule
+    :type ttl: int
+    :param ttl: pod record TTL in seconds
+    :type now: float
+    :param now: current time
+    :rtype: float (delay in seconds before the next attempt)
+    """
+
+    target.acked = None
+    target.damper += 1
+    left = target.deadline - now
+    cap = left * 0.5 if left > 0 else ttl * 0.75
+    delay = max(0.25, min(0.25 * (2 ** min(target.damper, 16)), cap)) + uniform(0, 0.25)
+    target.next = now + delay
+    return delay
+
+
 class Actor(FSM):
 
     """
-    Actor emitting a periodic HTTP POST request against the controlling party. This enables us
+    Actor emitting a periodic keepalive RPC request against the controlling parties. This enables us
     to report relevant information about the pod. The pod UUID is derived from its IPv4 address
     and launch time shortened via base 62 encoding. A random nonce is added to the payload to make
     sure a pod with a given ip being restarted (or at least the kontrol process) triggers a
     digest change.
 
+    One single actor serves all the masters : the payload is loaded and assembled once per change
+    and the same object is handed over to the piper for each target. Each target keeps its own
+    randomized cadence and backs off upon failure while making sure the pod record does not expire.
+    Once a target acknowledged a given record we just send it a small heartbeat (pod key, nonce and
+    record hash) until the record changes, held off as long as the record has some time left when the
+    target reports load.
+
     @note the IP retrieved from the K8S API at boot time appears to be missing depending on timing
     """
 
     tag = 'keepalive'
 
-    def __init__(self, cfg, target):
+    def __init__(self, cfg, targets):
 
         super(Actor, self).__init__()
 
+        self.beat = None
         self.cfg = cfg
-        self.data.last = 0
-        self.data.next = 0
+        self.js = None
         self.key = '%s' % self._shorten(struct.unpack("!I", inet_aton(cfg['ip']))[0])
         self.nonce = os.urandom(8).encode('hex')
-        self.path = '%s actor (%s)' % (self.tag, target)
+        self.path = '%s actor' % self.tag
         self.payload = ''
         self.state = 'up'
-        self.statsd = statsd.StatsClient('127.0.0.1', 8125)
-        self.target = target
-        
-        logger.info('%s : now using key %s (pod %s)' % (self.path, self.key, cfg['id']))
+        self.targets = {}
+        self.watcher = None
+
+        #
+        # - each target is scheduled on its own (see track())
+        #
+        now = time.time()
+        for host in targets:
+            self.targets[host] = track(host, int(cfg['ttl']), now)
+
+        self.status['targets'] = {host: {'failures': 0, 'latency': None, 'load': 0.0} for host in targets}
+
+        logger.info('%s : now using key %s (pod %s, %d masters)' % (self.path, self.key, cfg['id'], len(targets)))
 
     def reset(self, data):
 
@@ -55,76 +247,132 @@ class Actor(FSM):
 
         return 'initial', data, 0.0
 
-    def initial(self, data):
-        
+    def on_start(self):
+
         #
         # - $KONTROL_PAYLOAD is optional and can be set to point to a file
         #   on disk that contains json user-data (for instance some statistics)
-        # - this free-form payload will be included in the keepalive HTTP PUT,
+        # - this free-form payload will be included in the keepalive,
         #   persisted in etcd and made available to the callback script
-        # - stat the file and force a keepalive if it changed
-        # - silently skip any error
-        #
-        # @todo monitor the payload file and force a keepalive upon update
+        # - watch the file and force a keepalive whenever it is updated
+        # - load it upfront so that our first keepalive includes it
         #
-        force = False
         if 'payload' in self.cfg:
-                try:
-                    updated = os.stat(self.cfg['payload']).st_mtime
-                    if updated > data.last:
-                        data.last = updated
-                        logger.debug('%s : loading %s' % (self.path, self.cfg['payload']))
-                        with open(self.cfg['payload'], 'r') as f:
-                            self.payload = json.loads(f.read())
-                            force = True
-            
-                except (IOError, OSError, ValueError):
-                    pass
+            self.watcher = Watcher(self.cfg['payload'], lambda: self.actor_ref.tell({'request': 'payload'}))
+            self.watcher.start()
+            self._load()
 
-        now = time.time()
-        if self.terminate or force or now > data.next:
+        super(Actor, self).on_start()
 
-            #
-            # - assemble the payload that will be reported periodically to the masters
-            #   via the keepalive /PUT request
-            #
-            js = \
-            {
-                'app': self.cfg['labels']['app'],
-                'id': self.cfg['id'],
-                'ip': self.cfg['ip'],
-                'key': self.key,
-                'nonce': self.nonce,
-                'payload': self.payload,
-                'role': self.cfg['labels']['role']
-            }
+    def on_stop(self):
+
+        if self.watcher:
+            self.watcher.stop()
+
+    def initial(self, data):
+
+        #
+        # - emit whatever keepalive is due
+        # - sleep until the next one (but not too long so that we remain
+        #   responsive upon shutdown)
+        #
+        self._ping()
+        if self.terminate:
+            raise Aborted('resetting')
+
+        lapse = min(target.next for target in self.targets.values()) - time.time()
+        return 'initial', data, min(1.0, max(0.05, lapse))
+
+    def specialized(self, msg):
+        assert 'request' in msg, 'bogus message received ?'
+        req = msg['request']
+        if req == 'payload':
 
             #
-            # - if we are going down force a keepalive and set the down trigger
-            # - this allows the leader to gracefully skim this pod 
+            # - the watcher detected an update to the payload file
+            # - load it and force a keepalive right away
             #
-            if self.terminate:
-                js['down'] = True
+            if self._load():
+                self._ping(force=True)
+
+        elif req == 'ack':
 
             #
-            # - simply HTTP PUT our cfg with a 1 second timeout
-            # - the ping frequency is once every TTL * 0.75 seconds
-            # - please note any failure to post will be handled with exponential backoff by
-            #   the state-machine
-            #
-            # @todo use TLS
+            # - outcome of a ping reported by the piper
+            # - update the target schedule (see acknowledged() and failed())
+            # - if the target asks for the full record send it right away
             #
             ttl = int(self.cfg['ttl'])
-            payload = (self.target, json.dumps(js, sort_keys=True))
-            logger.debug('%s : ping @ %s' % (self.path, self.target))
-            outgoing.put(payload)
-            data.next = now + ttl * 0.75       
-            self.statsd.incr('keepalive_emitted,tier=kontrol')
+            target = self.targets[msg['target']]
+            if msg['ok']:
+                resend = acknowledged(target, ttl, msg['hash'], msg['reply'], msg['tick'])
+                self.status['targets'][target.host].update({'failures': 0, 'latency': time.time() - msg['tick'], 'load': target.load})
+                if resend:
+                    logger.debug('%s : %s requested the full record' % (self.path, target.host))
+                    self._ping()
+            else:
+                delay = failed(target, ttl, time.time())
+                self.status['targets'][target.host]['failures'] = target.damper
+                logger.debug('%s : ping @ %s failed, retrying in %2.1f s' % (self.path, target.host, delay))
+        else:
+            super(Actor, self).specialized(msg)
 
-        if self.terminate:
-            raise Aborted('resetting')
+    def _load(self):
+
+        #
+        # - load the payload file
+        # - silently skip any error
+        #
+        try:
+            logger.debug('%s : loading %s' % (self.path, self.cfg['payload']))
+            with open(self.cfg['payload'], 'r') as f:
+                self.payload = json.loads(f.read())
+                self.js = None
+                return True
+
+        except (IOError, OSError, ValueError):
+            return False
 
-        return 'initial', data, 0.25
+    def _ping(self, force=False):
+
+        #
+        # - assemble the payload that will be reported periodically to the masters
+        #   via the keepalive RPC request
+        # - this is only done upon a change and shared by all the targets
+        # - if we are going down force a keepalive and set the down trigger
+        # - this allows the leader to gracefully skim this pod
+        #
+        if self.js is None or self.terminate:
+            self.js, self.beat = assemble(self.cfg, self.key, self.nonce, self.payload, down=self.terminate)
+
+        now = time.time()
+        ttl = int(self.cfg['ttl'])
+        for target in self.targets.values():
+            if due(target, ttl, self.js['hash'], now, force=self.terminate or force):
+
+                #
+                # - send the full record unless the target acknowledged this exact
+                #   content already, in which case a heartbeat is enough
+                # - hand the payload as is to the piper, zerorpc will msgpack it
+                # - it is only serialized to json once persisted in etcd by the master
+                # - the ping frequency is once every TTL * 0.64 to 0.75 seconds, up to
+                #   TTL * 0.9 for heartbeats when the target is fully loaded
+                # - the piper will report back the outcome via ack()
+                #
+                # @todo use TLS
+                #
+                full = self.terminate or target.acked != self.js['hash']
+                logger.debug('%s : ping @ %s%s' % (self.path, target.host, '' if full else ' (heartbeat)'))
+                outgoing.put((target.host, self.js if full else self.beat, self._ack(target.host, self.js['hash'], now)))
+                metrics.incr('keepalive_emitted,tier=kontrol')
+
+    def _ack(self, host, digest, tick):
+
+        #
+        # - callable invoked by the piper from the gevent hub
+        # - simply forward the outcome to the actor
+        #
+        return lambda ok, reply: self.actor_ref.tell({'request': 'ack', 'target': host, 'hash': digest, 'ok': ok, 'reply': reply, 'tick': tick})
 
     def _shorten(self, n):
 
@@ -136,4 +384,4 @@ class Actor(FSM):
         while n:
             out = alphabet[n % 62] + out
             n = int(n / 62)
-        return out
\ No newline at end of file
+        return out
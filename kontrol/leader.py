@@ -1,14 +1,14 @@
-import etcd
 import hashlib
 import json
 import kontrol
 import logging
 import os
 import time
-import statsd
 
+from kontrol import metrics, store
 from kontrol.fsm import Aborted, FSM, MSG
 from kontrol.main import actors
+from kontrol.store import KeyNotFound, Unavailable, WatchTimedOut
 
 #: our ochopod logger
 logger = logging.getLogger('kontrol')
@@ -27,11 +27,12 @@ class Actor(FSM):
         super(Actor, self).__init__()
 
         self.cfg = cfg
-        self.client = etcd.Client(host=cfg['etcd'], port=2379)
+        self.client = store.connect(cfg)
+        self.watcher = store.connect(cfg, watch=True)
         self.md5 = None
         self.path = '%s actor' % self.tag
         self.snapshot = {}
-        self.statsd = statsd.StatsClient('127.0.0.1', 8125)
+        self.status.update({'md5': None, 'pods': 0})
 
         if 'callback' not in cfg:
             logger.warning('%s: $KONTROL_CALLBACK is not set (user error ?)' % self.path)
@@ -48,7 +49,7 @@ class Actor(FSM):
                 logger.debug('%s : clearing the lock' % self.path)
                 self.client.delete(data.lock)
            
-            except (etcd.EtcdConnectionFailed, etcd.EtcdKeyNotFound):
+            except (KeyNotFound, Unavailable):
                 pass
 
         if self.terminate:
@@ -81,20 +82,33 @@ class Actor(FSM):
         try:
             self.client.refresh(data.lock, ttl=self.cfg['fover'])
       
-        except EtcdKeyNotFound:
+        except KeyNotFound:
             raise Aborted('lost key %s (excessive lag ?)' % data.lock)
 
         #
         # - query the lock directory
-        # - sort the keys and compare against ours
+        # - order the keys by creation index and compare against ours
         # - if we're first we own the lock
         #
         logger.debug('%s : attempting to grab lock' % self.path)
         items = [item for item in self.client.read('%s/locks' % self.cfg['prefix'], recursive=True).leaves] 
-        ordered = sorted(item.key for item in items)        
+        ordered = [item.key for item in sorted(items, key=lambda item: item.created)]
         if data.lock == ordered[0]:
             logger.info('%s : now acting as leader' % self.path)
-            self.statsd.incr('lock_obtained,tier=kontrol')
+            metrics.incr('lock_obtained,tier=kontrol')
+
+            #
+            # - load the last digest the callback was successfully run against
+            # - this way we won't re-run it if nothing changed since (e.g upon fail-over
+            #   or when the masters are restarted)
+            #
+            try:
+                self.md5 = self.client.read('%s/digest' % self.cfg['prefix']).value
+                logger.debug('%s : last applied MD5 -> %s' % (self.path, self.md5))
+
+            except KeyNotFound:
+                pass
+
             return 'watch', data, 0.0
 
         #
@@ -115,22 +129,22 @@ class Actor(FSM):
         try:
             self.client.refresh(data.lock, ttl=self.cfg['fover'])
         
-        except etcd.EtcdKeyNotFound:
+        except KeyNotFound:
             raise Aborted('lost key %s (excessive lag ?)' % data.lock)
 
         try:
 
             #
             # - block/wait on the dirty watch set off by the sequence actor
-            # - use a timeout of 0.75 x $KONTROL_FOVER and *divide by 2* as it appears python-etcd
-            #   blocks for twice the prescribed timeout (!?)
+            # - use a timeout of 0.75 x $KONTROL_FOVER
+            # - the watch runs over its own connection
             # - silently skip timeouts (worst case scenario)
             #
             tick = time.time()
-            self.client.watch('%s/_dirty' % self.cfg['prefix'], timeout=int(self.cfg['fover'] * 0.375))
+            self.watcher.watch('%s/_dirty' % self.cfg['prefix'], timeout=int(self.cfg['fover'] * 0.75))
             logger.debug('%s : dirty watch triggered' % self.path)
 
-        except (etcd.EtcdWatchTimedOut, etcd.EtcdConnectionFailed):
+        except (Unavailable, WatchTimedOut):
             pass
 
         #
@@ -147,9 +161,11 @@ class Actor(FSM):
         raw = self.client.read('%s/pods' % self.cfg['prefix'], recursive=True)
         pods = [json.loads(item.value) for item in raw.leaves if item.value]
         self.snapshot = sorted([pod for pod in pods if 'down' not in pod], key=lambda pod: pod['seq'])
-        hasher.update(json.dumps(self.snapshot))
+        serialized = json.dumps(self.snapshot)
+        hasher.update(serialized)
         md5 = ':'.join(c.encode('hex') for c in hasher.digest())
         logger.debug('%s : MD5 -> %s' % (self.path, md5))
+        self.status.update({'md5': md5, 'pods': len(self.snapshot)})
         if md5 != self.md5:
             self.md5 = md5
             if 'callback' in self.cfg:
@@ -159,13 +175,16 @@ class Actor(FSM):
                 # - use the damper to specify when to run
                 # - please note this may lead to multiple requests buffered by
                 #   the callback actor
+                # - the snapshot is passed as is as well for plugins and workers, which
+                #   saves them from re-parsing $PODS
                 #
                 msg = MSG({'request': 'invoke'})
                 msg.cmd = self.cfg['callback']
-                msg.env = {'MD5': md5, 'PODS': json.dumps(self.snapshot)}   
+                msg.env = {'MD5': md5, 'PODS': serialized}
+                msg.pods = self.snapshot
                 msg.ttl = now + int(self.cfg['damper'])
                 actors['callback'].tell(msg)
-                self.statsd.incr('md5_changed,tier=kontrol')
+                metrics.incr('md5_changed,tier=kontrol')
                 logger.debug('%s : MD5 update, requesting callback' % self.path)
 
         return 'watch', data, 0.0
\ No newline at end of file
@@ -2,7 +2,7 @@ import logging
 import time
 import weakref
 
-from collections import deque
+from collections import OrderedDict
 from threading import Thread, RLock
 
 
@@ -21,10 +21,9 @@ class LRU(object):
     def __init__(self, grace=60.0, capacity=None, evicted=None):
        
         self.capacity = capacity
-        self.dict = {}
+        self.dict = OrderedDict()
         self.evicted = evicted
         self.grace = grace
-        self.last = deque()
         self.lock = RLock()
         
         class _Cleaner(Thread):
@@ -47,50 +46,52 @@ class LRU(object):
         _Cleaner(self).start()
 
     def __getitem__(self, key):
+
+        #
+        # - the dict is kept ordered from the least to the most recently used key
+        # - move the key to the end upon access
+        #
         with self.lock:
             if not key in self.dict:
                 return None
-            self.last.remove(key)
-            self.last.appendleft(key)
-            val, _ = self.dict[key]
-            payload = (val, time.time())
-            self.dict[key] = payload
-            cur = len(self.dict)
+            val, _ = self.dict.pop(key)
+            self.dict[key] = (val, time.time())
             return val
 
+    def __len__(self):
+        with self.lock:
+            return len(self.dict)
+
     def __setitem__(self, key, val):
         with self.lock:
-            if key in self.dict:
-                self.last.remove(key)
-            
-            payload = (val, time.time())
-            self.last.appendleft(key)
-            self.dict[key] = payload
+            self.dict.pop(key, None)
+            self.dict[key] = (val, time.time())
             cur = len(self.dict)
             logger.debug('lru cache : + key "%s" (%d keys)' % (key, cur))
             if self.capacity is not None and cur > self.capacity:
-                key = self.last.pop()
-                val, _ = self.dict[key]
+                key, (val, _) = self.dict.popitem(last=False)
                 if self.evicted is not None:
                     self.evicted(val)
-                del self.dict[key]
                 logger.debug('lru cache : - key "%s"' % key)
 
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.dict.pop(key, (default, None))[0]
 
     def evict(self):
+
+        #
+        # - drop whatever was not used for a while, starting from the least recently
+        #   used key and stopping at the first one that is still fresh
+        #
         with self.lock:
             now = time.time()
-            for key, payload in self.dict.items():
-                val, tick = payload
-                if now - tick > self.grace:
-                    self.last.remove(key)
-                    val, _ = self.dict[key]
-                    if self.evicted is not None:
-                        self.evicted(val)
-                    del self.dict[key]
-                    logger.debug('lru cache : - key "%s"' % key)
-                
-
-
-
+            while self.dict:
+                key, (val, tick) = next(self.dict.iteritems())
+                if now - tick <= self.grace:
+                    break
 
+                del self.dict[key]
+                if self.evicted is not None:
+                    self.evicted(val)
+                logger.debug('lru cache : - key "%s"' % key)
@@ -1,21 +1,23 @@
 import argparse
+import copy
 import gevent
 import json
 import logging
 import os
 import signal
 import sys
-import urllib3
+import time
 import zerorpc
 
-from collections import OrderedDict
+from collections import deque, OrderedDict
 from gevent.queue import Queue
 from logging import DEBUG
 from logging.config import fileConfig
-from kontrol.fsm import MSG, diagnostic, shutdown
+from kontrol import metrics
+from kontrol.bridge import Latch, Stream
+from kontrol.fsm import MSG, diagnostic, shutdown, statuses
 from kontrol.lru import LRU
 from os.path import dirname
-from pykka import ThreadingFuture, Timeout
 from signal import signal, SIGINT, SIGTERM
 
 
@@ -25,25 +27,37 @@ actors = OrderedDict()
 #: Our automaton logger.
 logger = logging.getLogger('kontrol')
 
-#: gevent queue for outgoing RPC requests
+#: gevent queue for outgoing RPC requests, as (host, payload, ack) tuples where ack is an
+#: optional callable invoked with the outcome and the master reply
 outgoing = Queue()
 
+#: incoming keepalive states, drained by the sequence actor
+incoming = deque()
+
+#: last full keepalive persisted for each pod key, including its hash (maintained by the sequence actor
+#: and evicted once the pod stopped reporting for a TTL)
+records = LRU()
+
+#: number of buffered keepalives at which we report being fully loaded
+OVERLOAD = 1024
+
+#: maximum number of keepalives packed in a single ping_batch() request
+BATCH = 256
+
 
 class API(object):
 
     """
-    RPC front-end API with two requests: ping() and execute(). The startup logic with all
-    the actor setup is done in the ctor.
+    RPC front-end API with five requests: ping(), ping_batch(), stats(), invoke() and invoke_stream().
+    The startup logic with all the actor setup is done in the ctor.
+
+    If $KONTROL_MODE contains "relay" the incoming keepalives are not persisted but forwarded
+    as is to our own masters. This is meant to run as a sidecar aggregating keepalives from
+    co-located pods so that they reach the masters in batches.
     """
 
     def __init__(self):
 
-        #
-        # - disable the default 3 retries that urllib3 enforces
-        # - that causes the etcd watch to potentially wait 3X
-        #
-        from urllib3.util import Retry
-        urllib3.util.retry.Retry.DEFAULT = Retry(1)
         def _try(key):
             value = os.environ[key]
             try:
@@ -63,7 +77,7 @@ class API(object):
         [logger.info(' - $%s -> %s' % (key, os.environ[key])) for key in keys]
         assert all(key in js for key in ['id', 'etcd', 'ip', 'labels', 'annotations', 'mode', 'damper', 'ttl', 'fover']), '1+ environment variables missing'
         tokens = set(js['mode'].split(','))
-        assert all(key in ['slave', 'master', 'debug', 'verbose'] for key in tokens), 'invalid $KONTROL_MODE value'
+        assert all(key in ['slave', 'master', 'relay', 'debug', 'verbose'] for key in tokens), 'invalid $KONTROL_MODE value'
  
         #
         # - if $KONTROL_MODE contains "debug" switch the debug/local mode on
@@ -91,6 +105,12 @@ class API(object):
             }
             js.update(overrides)
 
+        #
+        # - $KONTROL_METRICS optionally sets where our metrics are flushed to
+        # - default to the local statsd/telegraf endpoint
+        #
+        metrics.configure(js['metrics'] if 'metrics' in js else 'statsd://127.0.0.1:8125')
+
         from kontrol.script import Actor as Script
         from kontrol.callback import Actor as Callback
         from kontrol.keepalive import Actor as KeepAlive
@@ -100,13 +120,22 @@ class API(object):
         #
         # - slave mode just requires the KeepAlive and Script actors
         # - split the comma separated list of masters
-        # - turn each into a KeepAlive actor
+        # - one single KeepAlive actor pings all of them
         # - don't forget to add the Script actor as well
+        # - relay mode also needs the list of masters to forward to
         #
-        if 'slave' in tokens:
+        self.clients = LRU(evicted=lambda client: client.close())
+        self.masters = []
+        self.relay = 'relay' in tokens
+        self.relayed = LRU(grace=float(js['ttl'])) if self.relay else None
+        records.grace = float(js['ttl'])
+        assert not (self.relay and 'master' in tokens), 'invalid $KONTROL_MODE value: relay and master are exclusive'
+        if 'slave' in tokens or self.relay:
             assert 'kontrol.unity3d.com/master' in js['annotations'], 'invalid annotations: "kontrol.unity3d.com/master" missing (bug?)'
-            masters = js['annotations']['kontrol.unity3d.com/master'].split(',')
-            stubs += [(KeepAlive, token) for token in masters] + [Script]
+            self.masters = js['annotations']['kontrol.unity3d.com/master'].split(',')
+
+        if 'slave' in tokens:
+            stubs += [(KeepAlive, self.masters), Script]
 
         #
         # - master mode requires the Callback, Leader and Sequence actors
@@ -141,51 +170,222 @@ class API(object):
     def ping(self, raw):
 
         """
-        RPC API: keepalive from a slave. This request does not return anything.
-
-        :type raw: str
-        :param raw: serialized json payload
-        :rtype: None
+        RPC API: keepalive from a slave. The keepalive is either the full pod record or a
+        heartbeat (just the pod key, nonce and record hash) if its content did not change.
+        A heartbeat is only accepted if we hold a record with a matching hash, otherwise
+        the slave is asked to resend it in full. Nothing is returned if the keepalive could
+        not be processed so that the slave does not take it as acknowledged.
+
+        :type raw: dict or str
+        :param raw: keepalive payload, either as is or serialized to json (older slaves)
+        :rtype: dict with the "resend" flag set if the full record is needed plus a "load" hint
         """
 
         try:
-            js = json.loads(raw)
-            logger.debug('RPC ping() <- %s [%s]' % (js['ip'], js['app']))
-            actors['sequence'].tell({'request': 'update', 'state': js})
+            js = _decode(raw)
+            logger.debug('RPC ping() <- %s%s' % (js['key'], ' (heartbeat)' if is_heartbeat(js) else ''))
+            return {'load': self._load(), 'resend': len(self._ingest([js])) > 0}
 
         except Exception:
-            pass
+            return None
+
+    def ping_batch(self, raws):
+
+        """
+        RPC API: batch of keepalives, typically forwarded by a relay. Each entry is processed
+        as if it came from ping() and any invalid one is skipped.
+
+        :type raws: list
+        :param raws: list of keepalive payloads
+        :rtype: dict with the "resend" list of pod keys whose full record is needed plus a "load" hint
+        """
+
+        batch = []
+        for raw in raws:
+            try:
+                batch.append(_decode(raw))
+
+            except Exception:
+                pass
+
+        logger.debug('RPC ping_batch() <- %d keepalives' % len(batch))
+        return {'load': self._load(), 'resend': self._ingest(batch)}
+
+    def _load(self):
+
+        #
+        # - load hint between 0 and 1 reported back to the slaves so that they
+        #   can space their keepalives out
+        # - this is based on how many keepalives are buffered for the sequence
+        #   actor (or for the piper if we are relaying)
+        #
+        backlog = outgoing.qsize() if self.relay else len(incoming)
+        return min(1.0, backlog / float(OVERLOAD))
+
+    def _ingest(self, batch):
+
+        #
+        # - heartbeats are only valid if we know about the corresponding full record
+        #   (as persisted by the sequence actor, or cached if we are relaying)
+        # - otherwise flag the pod key for a resend and skip
+        #
+        resend = []
+        for js in batch:
+            key = js['key']
+            if is_heartbeat(js):
+                known = self.relayed[key] if self.relay else records[key]
+                if not known or known['hash'] != js['hash']:
+                    resend.append(key)
+                    continue
+
+            elif self.relay and 'hash' in js:
+                self.relayed[key] = js
+
+            #
+            # - in relay mode simply forward the payloads to each master
+            # - the piper will pack them into ping_batch() requests
+            # - otherwise buffer the states for the sequence actor
+            #
+            if self.relay:
+                for master in self.masters:
+                    outgoing.put((master, js, self._forwarded(master, key)))
+            else:
+                incoming.append(js)
+
+        return resend
+
+    def _forwarded(self, master, key):
+
+        #
+        # - outcome of a relayed keepalive
+        # - if the master asks for the full record resend our cached copy
+        #
+        def _ack(ok, reply):
+            js = self.relayed[key]
+            if ok and reply and reply.get('resend') and js:
+                outgoing.put((master, js, None))
+
+        return _ack
+
+    def stats(self):
+
+        """
+        RPC API: runtime statistics. This includes for each actor its current state, mailbox depth
+        and whatever specific status it reports (for instance the latest MD5 digest for the leader
+        or the per-master keepalive latency). The RPC queues and client cache are included as well.
+        This is cheap and does not involve the actors.
+
+        :rtype: dict
+        """
+
+        js = \
+        {
+            'actors': {},
+            'clients': len(self.clients),
+            'incoming': len(incoming),
+            'outgoing': outgoing.qsize()
+        }
+
+        for tag, ref in actors.items():
+            status = copy.deepcopy(statuses.get(ref.actor_urn, {}))
+            status['mailbox'] = ref.actor_inbox.qsize()
+            js['actors'][tag] = status
+
+        return js
 
     def invoke(self, raw):
 
         """
         RPC API: shell invokation on behalf of the master. The code is run by
-        the script actor and its stdout returned back to the caller.
+        the script actor and its stdout returned back to the caller. The payload
+        must contain the "cmd" to run and may specify a "timeout" in seconds
+        (60 by default) plus a serialization "key".
 
-        :type raw: str
-        :param raw: serialized json payload
+        :type raw: dict or str
+        :param raw: request payload, either as is or serialized to json
         :rtype: the shell script stdout upon succes, None upon failure
         """
 
         try:
-            js = json.loads(raw)
-
-            logger.debug('RPC invoke() <- "%s"' % js['cmd'])
-            msg = MSG({'request': 'invoke'})
-            msg.cmd = js['cmd']
-            msg.env = {'INPUT': json.dumps(js)}
-            msg.latch = ThreadingFuture()     
+            msg = self._script(raw)
+            msg.latch = Latch()
 
             #
             # - block on a latch and reply with whatever the shell script
             #   wrote to its standard output
+            # - the latch only suspends this greenlet : the hub keeps serving
+            #   other requests and the piper while the script runs
+            # - the script actor kills the script once its timeout expires, add
+            #   some grace period to account for the time spent queued
             #
             actors['script'].tell(msg)
-            return msg.latch.get(timeout=60)
+            return msg.latch.get(timeout=msg.timeout + 60.0)
             
-        except Exception as failure:
+        except (Exception, gevent.Timeout) as failure:
             return None
 
+    @zerorpc.stream
+    def invoke_stream(self, raw):
+
+        """
+        RPC API: streaming variant of invoke(). The shell script stdout is sent back
+        line by line as it is produced. The script is throttled if the caller does
+        not consume its output fast enough.
+
+        :type raw: dict or str
+        :param raw: request payload, either as is or serialized to json
+        :rtype: generator yielding each stdout line
+        """
+
+        msg = self._script(raw)
+        msg.stream = Stream()
+        actors['script'].tell(msg)
+        return msg.stream.drain(timeout=msg.timeout + 60.0)
+
+    def _script(self, raw):
+
+        #
+        # - turn the request payload into a message for the script actor
+        # - pass the whole payload down as $INPUT
+        #
+        js = _decode(raw)
+        logger.debug('RPC invoke() <- "%s"' % js['cmd'])
+        msg = MSG({'request': 'invoke'})
+        msg.cmd = js['cmd']
+        msg.env = {'INPUT': raw if isinstance(raw, basestring) else json.dumps(js)}
+        msg.key = js['key'] if 'key' in js else None
+        msg.latch = None
+        msg.stream = None
+        msg.timeout = float(js['timeout']) if 'timeout' in js else 60.0
+        return msg
+
+def is_heartbeat(js):
+
+    """
+    Tells whether a keepalive is a heartbeat (e.g just the pod key, nonce and record hash).
+
+    :type js: dict
+    :param js: the decoded keepalive
+    :rtype: bool
+    """
+    return 'hash' in js and 'id' not in js
+
+
+def _decode(raw):
+
+    """
+    Decodes a RPC payload. Payloads are sent as native msgpack objects by zerorpc, older
+    peers still send them serialized to json.
+
+    :type raw: dict or str
+    :param raw: the payload received over RPC
+    :rtype: dict
+    """
+    js = json.loads(raw) if isinstance(raw, basestring) else raw
+    assert isinstance(js, dict), 'invalid payload (expecting an object)'
+    return js
+
+
 def go():
 
     """
@@ -231,28 +431,119 @@ def go():
         #
         assert 'KONTROL_PORT' in os.environ, '$KONTROL_PORT undefined (configuration error ?)'
         port = int(os.environ['KONTROL_PORT'])
-        server = zerorpc.Server(API())
+        api = API()
+        server = zerorpc.Server(api)
         server.bind('tcp://0.0.0.0:%d' % port)
+        lru = api.clients
+        busy = {}
+        legacy = set()
+        def _send(host, batch):
+            ok = True
+            tick = time.time()
+            replies = [None] * len(batch)
+            try:
+
+                #
+                # - use a simple LRU cache with eviction to manage
+                #   the RPC clients
+                #
+                client = lru[host]
+                if not client:
+                    client = zerorpc.Client()
+                    client.connect('tcp://%s:%d' % (host, port))
+                    lru[host] = client
+
+                #
+                # - use ping_batch() which takes the keepalives as is
+                # - older masters do not implement it : fallback on
+                #   individual pings and remember not to try again
+                # - those expect each keepalive serialized to json
+                # - keep track of the reply for each keepalive (older masters
+                #   do not reply anything)
+                #
+                done = False
+                payloads = [js for js, _ in batch]
+                if host not in legacy:
+                    try:
+                        for n in range(0, len(payloads), BATCH):
+                            reply = client.ping_batch(payloads[n:n + BATCH])
+                            if reply is not None:
+                                resend = set(reply['resend'])
+                                for i in range(n, min(n + BATCH, len(payloads))):
+                                    replies[i] = {'load': reply.get('load', 0.0), 'resend': payloads[i]['key'] in resend}
+                        done = True
+
+                    except zerorpc.RemoteError as failure:
+                        if failure.name != 'NameError':
+                            raise
+                        logger.warning('RPC : %s does not support ping_batch(), falling back' % host)
+                        legacy.add(host)
+
+                if not done:
+                    for i, js in enumerate(payloads):
+                        replies[i] = client.ping(json.dumps(js))
+
+                metrics.timing('keepalive_latency,tier=kontrol', (time.time() - tick) * 1000)
+
+            except Exception as failure:
+                ok = False
+                metrics.incr('keepalive_failed,tier=kontrol')
+                logger.error('RPC : unable to ping() @ %s' % host)
+
+            #
+            # - report the outcome to whoever emitted the keepalives
+            # - this may fail if the emitter is gone in the meantime
+            #
+            for (_, ack), reply in zip(batch, replies):
+                try:
+                    if ack is not None:
+                        ack(ok, reply)
+
+                except Exception:
+                    pass
+
+        def _drain(host, batch):
+
+            #
+            # - one single send in flight per master
+            # - keepalives queued for that master meanwhile are held by _piper()
+            #   and sent in order once the current batch is done
+            #
+            while batch:
+                _send(host, batch)
+                batch = busy[host]
+                busy[host] = []
+
+            del busy[host]
+
         def _piper():
-            lru = LRU(evicted=lambda client: client.close())
             while 1:
-                host, js = outgoing.get()
-                try:
 
-                    #
-                    # - use a simple LRU cache with eviction to manage
-                    #   the RPC clients
-                    #
-                    client = lru[host]
-                    if not client:
-                        client = zerorpc.Client()
-                        client.connect('tcp://%s:%d' % (host, port))
-                        lru[host] = client
-                        
-                    client.ping(js)
-
-                except Exception as failure:
-                    logger.error('RPC : unable to ping() @ %s' % host)
+                #
+                # - block until we have at least one keepalive to send
+                # - in relay mode linger a bit to let more keepalives accumulate
+                # - drain whatever is pending and group it per master
+                # - each master is then pinged from its own greenlet so that an
+                #   unresponsive one does not delay the others
+                # - if a greenlet is already busy with that master just hand it the
+                #   batch instead of piling up concurrent sends
+                #
+                pending = OrderedDict()
+                host, js, ack = outgoing.get()
+                pending[host] = [(js, ack)]
+                if api.relay:
+                    gevent.sleep(0.1)
+
+                while not outgoing.empty():
+                    host, js, ack = outgoing.get_nowait()
+                    pending.setdefault(host, []).append((js, ack))
+
+                for host, batch in pending.items():
+                    if host in busy:
+                        busy[host] += batch
+                    else:
+                        busy[host] = []
+                        gevent.spawn(_drain, host, batch)
 
         #
         # - start the server and piper as greenlets
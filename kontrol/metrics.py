@@ -0,0 +1,187 @@
+import logging
+import socket
+import time
+
+from threading import RLock, Thread
+from urlparse import urlparse
+
+
+#: our ochopod logger
+logger = logging.getLogger('kontrol')
+
+#: maximum statsd packet size (fits within a typical ethernet MTU)
+MTU = 1432
+
+#: maximum number of timer samples buffered per key between two flushes
+SAMPLES = 1024
+
+
+class Statsd(object):
+
+    """
+    Sink packing the metric lines into as few UDP datagrams as possible.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8125):
+
+        self.address = (host, port)
+        self.fd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def emit(self, lines):
+
+        packet = ''
+        for line in lines:
+            if packet and len(packet) + len(line) + 1 > MTU:
+                self._send(packet)
+                packet = ''
+            packet = '%s\n%s' % (packet, line) if packet else line
+
+        if packet:
+            self._send(packet)
+
+    def _send(self, packet):
+        try:
+            self.fd.sendto(packet, self.address)
+
+        except socket.error:
+            pass
+
+
+class File(object):
+
+    """
+    Sink appending the metric lines to a file, prefixed by a timestamp.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+
+    def emit(self, lines):
+
+        now = int(time.time())
+        with open(self.path, 'a') as f:
+            f.write(''.join('%d %s\n' % (now, line) for line in lines))
+
+
+class Memory(object):
+
+    """
+    Sink keeping the metric lines in memory, mostly useful for testing.
+    """
+
+    def __init__(self):
+
+        self.lines = []
+
+    def emit(self, lines):
+
+        self.lines += lines
+
+
+class Registry(object):
+
+    """
+    Process-wide metrics registry with counters, gauges and timers. Everything is aggregated
+    locally and periodically flushed in one go to a configurable sink. The sink is specified
+    as a URL, for instance statsd://127.0.0.1:8125, file:///tmp/metrics.log or memory://.
+    Nothing is emitted until the registry is configured.
+    """
+
+    def __init__(self):
+
+        self.counters = {}
+        self.every = 5.0
+        self.gauges = {}
+        self.lock = RLock()
+        self.sink = None
+        self.timers = {}
+
+    def configure(self, url, every=5.0):
+
+        """
+        Sets the sink and starts flushing periodically.
+
+        :type url: str
+        :param url: sink URL
+        :type every: float
+        :param every: flush period in seconds
+        """
+
+        parsed = urlparse(url)
+        if parsed.scheme == 'statsd':
+            sink = Statsd(parsed.hostname or '127.0.0.1', parsed.port or 8125)
+        elif parsed.scheme == 'file':
+            sink = File(parsed.path)
+        elif parsed.scheme == 'memory':
+            sink = Memory()
+        else:
+            assert 0, 'invalid metrics sink "%s"' % url
+
+        logger.debug('metrics : flushing to %s every %2.1f s' % (url, every))
+        with self.lock:
+            running = self.sink is not None
+            self.every = every
+            self.sink = sink
+
+        if not running:
+            flusher = Thread(target=self._run)
+            flusher.daemon = True
+            flusher.start()
+
+        return sink
+
+    def incr(self, key, count=1):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + count
+
+    def gauge(self, key, value):
+        with self.lock:
+            self.gauges[key] = value
+
+    def timing(self, key, ms):
+        with self.lock:
+            samples = self.timers.setdefault(key, [])
+            if len(samples) < SAMPLES:
+                samples.append(ms)
+
+    def flush(self):
+
+        """
+        Emits whatever was aggregated since the last flush. Counters and timers are reset
+        while gauges keep their last value.
+        """
+
+        with self.lock:
+            sink = self.sink
+            counters, self.counters = self.counters, {}
+            timers, self.timers = self.timers, {}
+            gauges = dict(self.gauges)
+
+        if sink is None:
+            return
+
+        lines = ['%s:%d|c' % (key, value) for key, value in counters.items()]
+        lines += ['%s:%s|g' % (key, value) for key, value in gauges.items()]
+        lines += ['%s:%d|ms' % (key, ms) for key, samples in timers.items() for ms in samples]
+        if lines:
+            sink.emit(lines)
+
+    def _run(self):
+        while 1:
+            time.sleep(self.every)
+            try:
+                self.flush()
+
+            except Exception as failure:
+                logger.debug('metrics : unable to flush (%s)' % failure)
+
+
+#: the process-wide registry
+registry = Registry()
+
+configure = registry.configure
+flush = registry.flush
+gauge = registry.gauge
+incr = registry.incr
+timing = registry.timing
@@ -0,0 +1,508 @@
+import cPickle
+import importlib
+import json
+import logging
+import os
+import signal
+import sys
+import time
+import traceback
+
+from subprocess import Popen, PIPE, STDOUT
+from threading import Event, Thread, Timer
+
+
+#: our ochopod logger
+logger = logging.getLogger('kontrol')
+
+
+class Runner(object):
+
+    """
+    Subprocess wrapper draining its standard outputs as lines are produced and signaling
+    completion as soon as the child exits. Each pipe is read by its own daemon thread (which
+    means the child can never block on a full pipe) while a waiter thread reaps the child and
+    invokes the optional exit callback once both pipes are drained.
+
+    The subprocess runs in its own process group so that it can be killed along with any
+    child it spawned, either explicitly or upon timeout.
+    """
+
+    def __init__(self, cmd, env=None, shell=False, merge=False, timeout=None, on_line=None, on_exit=None):
+
+        self.code = None
+        self.done = Event()
+        self.killed = False
+        self.lapse = None
+        self.on_exit = on_exit
+        self.stderr = []
+        self.stdout = []
+        self.tick = time.time()
+        self.timed_out = False
+        self.pid = Popen(cmd,
+        close_fds=True,
+        bufsize=0,
+        shell=shell,
+        env=env,
+        preexec_fn=os.setsid,
+        stderr=STDOUT if merge else PIPE,
+        stdout=PIPE)
+
+        #
+        # - stdout lines are either buffered or passed to the specified callable
+        # - stderr is always buffered unless merged with stdout
+        #
+        self.readers = [_drain(self.pid.stdout, on_line if on_line else self.stdout.append)]
+        if not merge:
+            self.readers.append(_drain(self.pid.stderr, self.stderr.append))
+
+        self.timer = Timer(timeout, self._expire) if timeout else None
+        if self.timer:
+            self.timer.daemon = True
+            self.timer.start()
+
+        waiter = Thread(target=self._wait)
+        waiter.daemon = True
+        waiter.start()
+
+    @property
+    def complete(self):
+        return self.done.is_set()
+
+    def kill(self, sig=signal.SIGTERM):
+
+        """
+        Sends a signal to the whole subprocess group.
+
+        :type sig: int
+        :param sig: the signal to send
+        """
+        try:
+            self.killed = True
+            os.killpg(self.pid.pid, sig)
+
+        except OSError:
+            pass
+
+    def _expire(self):
+        if not self.complete:
+            logger.warning('runner : pid %s timed out, killing its process group' % self.pid.pid)
+            self.timed_out = True
+            self.kill(signal.SIGKILL)
+
+    def _wait(self):
+
+        #
+        # - block until the child exits and its pipes are fully drained
+        # - then signal completion
+        #
+        self.code = self.pid.wait()
+        for reader in self.readers:
+            reader.join()
+
+        if self.timer:
+            self.timer.cancel()
+
+        self.lapse = time.time() - self.tick
+        self.done.set()
+        if self.on_exit:
+            try:
+                self.on_exit(self)
+
+            except Exception as failure:
+                logger.debug('runner : exit callback failed for pid %s (%s)' % (self.pid.pid, failure))
+
+
+def _drain(fd, sink):
+
+    """
+    Spawns a daemon thread reading lines from a pipe and passing them to a sink
+    until EOF.
+
+    :type fd: file
+    :param fd: the pipe to read from
+    :type sink: callable
+    :param sink: invoked with each line, stripped of its trailing newline
+    :rtype: :class:`threading.Thread`
+    """
+    def _run():
+        for line in iter(fd.readline, b''):
+            sink(line.rstrip('\n'))
+        fd.close()
+
+    thread = Thread(target=_run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class Job(object):
+
+    """
+    Single request submitted to a :class:`Worker`. It mimics the :class:`Runner` attributes
+    so that both can be handled the same way upon completion.
+    """
+
+    def __init__(self, worker, on_exit=None):
+
+        self.code = None
+        self.done = Event()
+        self.killed = False
+        self.lapse = None
+        self.on_exit = on_exit
+        self.pid = worker.pid
+        self.stderr = []
+        self.stdout = []
+        self.tick = time.time()
+        self.timed_out = False
+        self.timer = None
+        self.worker = worker
+
+    @property
+    def complete(self):
+        return self.done.is_set()
+
+    def kill(self, sig=signal.SIGTERM):
+        self.killed = True
+        self.worker.kill(sig)
+
+    def _finish(self, code, line=None):
+
+        if self.complete:
+            return
+
+        if self.timer:
+            self.timer.cancel()
+
+        if line is not None:
+            self.stdout.append(line)
+
+        self.code = code
+        self.lapse = time.time() - self.tick
+        self.done.set()
+        if self.on_exit:
+            try:
+                self.on_exit(self)
+
+            except Exception as failure:
+                logger.debug('runner : exit callback failed for pid %s (%s)' % (self.pid.pid, failure))
+
+
+class Worker(object):
+
+    """
+    Long-lived subprocess fed one json request per line over its standard input and
+    answering with exactly one line on its standard output. Requests are submitted one
+    at a time. The subprocess is lazily (re)started whenever it is not running, which
+    means a worker that crashed or was killed upon timeout is transparently replaced by
+    the next request.
+    """
+
+    def __init__(self, cmd, env=None, shell=False):
+
+        self.cmd = cmd
+        self.env = env
+        self.job = None
+        self.pid = None
+        self.shell = shell
+        self.stderr = []
+
+    @property
+    def alive(self):
+        return self.pid is not None and self.pid.poll() is None
+
+    def submit(self, request, timeout=None, on_exit=None):
+
+        """
+        Writes a request to the worker and returns the matching job. The job completes
+        as soon as the reply line is read or the worker exits.
+
+        :type request: dict
+        :param request: json-serializable request
+        :type timeout: float
+        :param timeout: optional timeout in seconds after which the worker is killed
+        :type on_exit: callable
+        :param on_exit: invoked with the job upon completion
+        :rtype: :class:`Job`
+        """
+
+        assert self.job is None or self.job.complete, 'worker busy (bug ?)'
+        if not self.alive:
+            self._spawn()
+
+        job = Job(self, on_exit=on_exit)
+        self.job = job
+        self.stderr[:] = []
+        if timeout:
+            job.timer = Timer(timeout, self._expire, (job,))
+            job.timer.daemon = True
+            job.timer.start()
+
+        try:
+            self.pid.stdin.write('%s\n' % json.dumps(request))
+            self.pid.stdin.flush()
+
+        except (IOError, ValueError):
+
+            #
+            # - the worker died in between, its reader will complete the job
+            #
+            pass
+
+        return job
+
+    def kill(self, sig=signal.SIGTERM):
+        try:
+            if self.pid:
+                os.killpg(self.pid.pid, sig)
+
+        except OSError:
+            pass
+
+    def stop(self):
+
+        """
+        Closes the worker standard input (which should make it exit) and kills it
+        for good measure.
+        """
+
+        if self.alive:
+            try:
+                self.pid.stdin.close()
+
+            except IOError:
+                pass
+
+            self.kill(signal.SIGKILL)
+
+    def _spawn(self):
+
+        self.pid = Popen(self.cmd,
+        close_fds=True,
+        bufsize=0,
+        shell=self.shell,
+        env=self.env,
+        preexec_fn=os.setsid,
+        stdin=PIPE,
+        stderr=PIPE,
+        stdout=PIPE)
+
+        logger.debug('runner : started worker (pid %s)' % self.pid.pid)
+        _drain(self.pid.stderr, self.stderr.append)
+        reader = Thread(target=self._read, args=(self.pid,))
+        reader.daemon = True
+        reader.start()
+
+    def _expire(self, job):
+        if not job.complete:
+            logger.warning('runner : worker pid %s timed out, killing its process group' % job.pid.pid)
+            job.timed_out = True
+            self.kill(signal.SIGKILL)
+
+    def _read(self, pid):
+
+        #
+        # - each line completes the pending job
+        # - upon EOF the worker is gone : reap it and fail whatever job was pending
+        #
+        for line in iter(pid.stdout.readline, b''):
+            job = self.job
+            if job and job.pid is pid:
+                job.stderr = list(self.stderr)
+                job._finish(0, line.rstrip('\n'))
+
+        pid.stdout.close()
+        code = pid.wait()
+        logger.debug('runner : worker pid %s exited (exit %d)' % (pid.pid, code))
+        job = self.job
+        if job and job.pid is pid:
+            job.stderr = list(self.stderr)
+            job._finish(code if code else -1)
+
+
+class Plugin(object):
+
+    """
+    Python callable specified as a *module:function* entry point and run in a dedicated
+    child process. The entry point is imported once by the child which then loops on
+    incoming requests, passing each one as keyword arguments and sending back whatever
+    it returns. Requests are submitted one at a time, and the child is lazily (re)started
+    whenever it is not running (e.g after it crashed or was killed upon timeout).
+
+    The child is a fresh interpreter started with our *sys.path* rather than a fork: we run
+    zmq and gevent threads whose locks and sockets a forked child would inherit in whatever
+    state they were in. Requests and replies are pickled over its standard input and output
+    and it runs in its own process group, just like a :class:`Worker`.
+    """
+
+    def __init__(self, entry):
+
+        self.entry = entry
+        self.job = None
+        self.pid = None
+
+    @property
+    def alive(self):
+        return self.pid is not None and self.pid.poll() is None
+
+    def submit(self, request, timeout=None, on_exit=None):
+
+        """
+        Hands a request over to the plugin and returns the matching job. The job
+        completes as soon as the function returns or the child process exits. The
+        returned value is serialized to json unless it is already a string.
+
+        :type request: dict
+        :param request: keyword arguments to pass to the function
+        :type timeout: float
+        :param timeout: optional timeout in seconds after which the child is killed
+        :type on_exit: callable
+        :param on_exit: invoked with the job upon completion
+        :rtype: :class:`Job`
+        """
+
+        assert self.job is None or self.job.complete, 'plugin busy (bug ?)'
+        if not self.alive:
+            self._spawn()
+
+        job = Job(self, on_exit=on_exit)
+        self.job = job
+        if timeout:
+            job.timer = Timer(timeout, self._expire, (job,))
+            job.timer.daemon = True
+            job.timer.start()
+
+        try:
+            cPickle.dump(request, self.pid.stdin, cPickle.HIGHEST_PROTOCOL)
+            self.pid.stdin.flush()
+
+        except (IOError, ValueError):
+
+            #
+            # - the child died in between, its reader will complete the job
+            #
+            pass
+
+        return job
+
+    def kill(self, sig=signal.SIGTERM):
+        try:
+            if self.pid:
+                os.killpg(self.pid.pid, sig)
+
+        except OSError:
+            pass
+
+    def stop(self):
+
+        """
+        Closes the child standard input (which makes it exit) and kills it for good
+        measure.
+        """
+
+        if self.alive:
+            try:
+                self.pid.stdin.close()
+
+            except IOError:
+                pass
+
+            self.kill(signal.SIGKILL)
+
+    def _spawn(self):
+
+        #
+        # - re-execute the interpreter with our own module search path
+        # - the child imports the entry point and serves requests over its stdin/stdout
+        # - its stdout is read by a daemon thread
+        #
+        cmd = [sys.executable, '-c', 'import sys; from kontrol.runner import _serve; _serve(sys.argv[1])', self.entry]
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        self.pid = Popen(cmd,
+        close_fds=True,
+        env=env,
+        preexec_fn=os.setsid,
+        stdin=PIPE,
+        stdout=PIPE)
+
+        logger.debug('runner : started plugin %s (pid %s)' % (self.entry, self.pid.pid))
+        reader = Thread(target=self._read, args=(self.pid,))
+        reader.daemon = True
+        reader.start()
+
+    def _expire(self, job):
+        if not job.complete:
+            logger.warning('runner : plugin pid %s timed out, killing its process group' % job.pid.pid)
+            job.timed_out = True
+            self.kill(signal.SIGKILL)
+
+    def _read(self, pid):
+
+        #
+        # - each reply completes the pending job, a failure being reported with its
+        #   traceback as stderr
+        # - upon EOF the child is gone : reap it and fail whatever job was pending
+        #
+        while 1:
+            try:
+                ok, out = cPickle.load(pid.stdout)
+
+            except (EOFError, IOError, cPickle.UnpicklingError):
+                break
+
+            job = self.job
+            if job and job.pid is pid:
+                if ok:
+                    job._finish(0, out)
+                else:
+                    job.stderr = out.rstrip('\n').split('\n')
+                    job._finish(1)
+
+        pid.stdout.close()
+        code = pid.wait()
+        logger.debug('runner : plugin pid %s exited (exit %s)' % (pid.pid, code))
+        job = self.job
+        if job and job.pid is pid:
+            job._finish(code if code else -1)
+
+
+def _serve(entry):
+
+    #
+    # - child process side of a plugin
+    # - keep a private copy of stdout for our replies and point fd 1 to stderr so that
+    #   whatever the function prints can't corrupt them
+    # - resolve the module:function entry point once and serve requests until stdin
+    #   is closed
+    #
+    replies = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    module, function = entry.split(':')
+    try:
+        fn = getattr(importlib.import_module(module), function)
+
+    except (AttributeError, ImportError):
+        fn = None
+        failure = traceback.format_exc()
+
+    def _reply(ok, value):
+        cPickle.dump((ok, value), replies, cPickle.HIGHEST_PROTOCOL)
+        replies.flush()
+
+    while 1:
+        try:
+            kwargs = cPickle.load(sys.stdin)
+
+        except (EOFError, IOError, cPickle.UnpicklingError):
+            break
+
+        if fn is None:
+            _reply(False, failure)
+            continue
+
+        try:
+            out = fn(**kwargs)
+            _reply(True, out if isinstance(out, basestring) else json.dumps(out))
+
+        except Exception:
+            _reply(False, traceback.format_exc())
@@ -4,8 +4,8 @@ import time
 
 from collections import deque
 from kontrol.fsm import Aborted, FSM
-from subprocess import Popen, PIPE, STDOUT
-from threading import Event, Thread
+from kontrol.runner import Runner
+from threading import Event
 
 #: our ochopod logger
 logger = logging.getLogger('kontrol')
@@ -14,10 +14,16 @@ class Actor(FSM):
 
     """
     Actor in charge of invoking an arbitrary command sent by the controller. The
-    sub-process stdout is piped back into the HTTP response. The controller is
+    sub-process stdout is piped back into the RPC response, either in one go or
+    line by line if the request is streamed. The controller is
     free to include free-form json data in its request. This json will be passed
     down as the $INPUT environment variable.
 
+    Up to $KONTROL_WORKERS scripts (4 by default) run concurrently. Each request
+    may specify a timeout in seconds after which the script process group is killed
+    and a serialization key : requests sharing the same key are run one at a time
+    and in order.
+
     @todo add some authentication mechanism to make sure the request is not forged
     #todo anything to do to secure/sandbox/limit what the controller can request ?
     """
@@ -30,6 +36,9 @@ class Actor(FSM):
         self.cfg = cfg
         self.fifo = deque()
         self.path = '%s actor' % self.tag
+        self.running = []
+        self.workers = int(cfg['workers']) if 'workers' in cfg else 4
+        self.status.update({'fifo': 0, 'running': 0})
 
     def reset(self, data):
 
@@ -40,66 +49,15 @@ class Actor(FSM):
 
     def initial(self, data):
                 
-        if self.terminate and not self.fifo:
+        if self.terminate and not self.fifo and not self.running:
             raise Aborted('resetting')
 
         #
-        # - just spin if there is nothing to invoke
-        #
-        if not self.fifo:
-            return 'initial', data, 0.25
-
+        # - completions and new requests are handled as they come in
+        # - just spin in case a worker freed up while we were busy
         #
-        # - set the popen call to use piping if required
-        # - spawn an ancillary thread to forward the lines to our logger
-        # - this thread will go down automatically when the sub-process does
-        #
-        msg = self.fifo[0]
-        data.latch = msg.latch
-        data.tick = time.time()
-        data.pid = Popen(msg.cmd,
-        close_fds=True,
-        shell=True,
-        bufsize=0,
-        env=msg.env,
-        stderr=PIPE,
-        stdout=PIPE)
-
-        logger.debug('%s : invoking script "%s" (pid %s)' % (self.path, msg.cmd, data.pid.pid))
-        return 'wait_for_completion', data, 0.25
-
-    def wait_for_completion(self, data):
-
-        #
-        # - stop spinning once the process has exited
-        # - both stderr and stdout are piped
-        #
-        if data.pid.poll() is not None:
-            code = data.pid.returncode
-            stdout = [line.rstrip('\n') for line in iter(data.pid.stdout.readline, b'')]
-            stderr = [line.rstrip('\n') for line in iter(data.pid.stderr.readline, b'')]
-            lapse = time.time() - data.tick
-            logger.info('%s: script took %2.1f s (pid %s, exit %d)' % (self.path, lapse, data.pid.pid, code))
-            if stderr:
-                logger.debug('%s : stderr (pid %s) -> \n  . %s' % (self.path, data.pid.pid, '\n  . '.join(stderr)))
-
-            #
-            # - release the latch to unblock the HTTP request
-            #   handler
-            #  
-            data.latch.set('\n'.join(stdout))
-            Event()
-
-            #
-            # - dequeue the FIFO
-            # - go back to the initial state
-            #
-            data.pid = None
-            self.fifo.popleft()
-            return 'initial', data, 0
-
-        return 'wait_for_completion', data, 0.25
-    
+        self._dispatch()
+        return 'initial', data, 1.0
 
     def specialized(self, msg):
         assert 'request' in msg, 'bogus message received ?'
@@ -108,9 +66,92 @@ class Actor(FSM):
 
             #
             # - buffer the incoming script in our fifo
-            # - we'll dequeue it upon the next spin
+            # - start it right away if we have a free worker
             #
             self.fifo.append(msg)
+            self._dispatch()
+
+        elif req == 'exited':
+
+            #
+            # - a script exited and its outputs are fully drained
+            # - complete it and start whatever is next
+            #
+            self._complete(msg['msg'])
+            self._dispatch()
+
         else:
             super(Actor, self).specialized(msg)
-        
\ No newline at end of file
+
+    def _dispatch(self):
+
+        #
+        # - start as many buffered requests as we have free workers
+        # - requests sharing the same serialization key run in order, one at a time
+        # - any request whose key is busy is skipped along with the ones behind it
+        #   using the same key
+        #
+        busy = set(msg.key for msg in self.running if msg.key)
+        for msg in list(self.fifo):
+            if len(self.running) >= self.workers:
+                break
+
+            if msg.key:
+                if msg.key in busy:
+                    continue
+                busy.add(msg.key)
+
+            self.fifo.remove(msg)
+            self._spawn(msg)
+
+        self.status.update({'fifo': len(self.fifo), 'running': len(self.running)})
+
+    def _spawn(self, msg):
+
+        #
+        # - run the script in its own process group so that it can be killed
+        #   along with its children upon timeout
+        # - its outputs are drained as the lines are produced
+        # - stdout is either buffered or pushed to the stream if the caller wants it
+        #   streamed back (in which case a slow consumer will throttle the script)
+        # - we'll be notified once it exits
+        # - if it can't be started fail the request right away, the caller would
+        #   otherwise wait until its own timeout
+        #
+        try:
+            msg.runner = Runner(msg.cmd,
+            env=msg.env,
+            shell=True,
+            timeout=msg.timeout,
+            on_line=msg.stream.put if msg.stream else None,
+            on_exit=lambda _: self.actor_ref.tell({'request': 'exited', 'msg': msg}))
+
+        except Exception as failure:
+            logger.warning('%s : unable to invoke script "%s" (%s)' % (self.path, msg.cmd, failure))
+            if msg.stream:
+                msg.stream.end(RuntimeError('unable to invoke script (%s)' % failure))
+            else:
+                msg.latch.set(None)
+            return
+
+        self.running.append(msg)
+        logger.debug('%s : invoking script "%s" (pid %s, %d running)' % (self.path, msg.cmd, msg.runner.pid.pid, len(self.running)))
+
+    def _complete(self, msg):
+
+        runner = msg.runner
+        self.running.remove(msg)
+        logger.info('%s: script took %2.1f s (pid %s, exit %d)' % (self.path, runner.lapse, runner.pid.pid, runner.code))
+        if runner.stderr:
+            logger.debug('%s : stderr (pid %s) -> \n  . %s' % (self.path, runner.pid.pid, '\n  . '.join(runner.stderr)))
+
+        #
+        # - close the stream or release the latch to unblock the RPC request
+        # - a script that timed out is reported as a failure (raised to the caller
+        #   after the lines it produced if streamed)
+        #
+        if msg.stream:
+            msg.stream.end(RuntimeError('script timed out after %d s' % msg.timeout) if runner.timed_out else None)
+        else:
+            msg.latch.set(None if runner.timed_out else '\n'.join(runner.stdout))
+            Event()
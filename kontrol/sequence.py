@@ -1,11 +1,11 @@
-import etcd
 import json
 import logging
 import time
 
-from collections import deque
-from etcd import EtcdAlreadyExist, EtcdKeyNotFound
+from kontrol import metrics, store
 from kontrol.fsm import Aborted, FSM
+from kontrol.main import incoming, is_heartbeat, records
+from kontrol.store import AlreadyExists, CompareFailed, KeyNotFound
 
 
 #: our ochopod logger
@@ -24,6 +24,10 @@ class Actor(FSM):
     This ordering is critical to properly compute the MD5 digest and
     enforce consistency when for instance rendering zookeeper templates or
     anything relying on integer indices.
+
+    Keepalives are buffered in the shared incoming queue by the RPC front-end
+    and drained in batches. The leader is only woken up once per batch. Heartbeats
+    (keepalives without any change) just refresh the TTL of the pod record.
     """
 
     tag = 'sequence'
@@ -32,10 +36,13 @@ class Actor(FSM):
         super(Actor, self).__init__()
 
         self.cfg = cfg
-        self.client = etcd.Client(host=cfg['etcd'], port=2379)
-        self.fifo = deque()
+        self.client = store.connect(cfg)
+        self.fifo = incoming
         self.path = '%s actor' % self.tag
 
+        self.data.dirty = False
+        self.status['fifo'] = 0
+
     def reset(self, data):
 
         if self.terminate:
@@ -56,14 +63,45 @@ class Actor(FSM):
             # - attempt to read its payload
             #
             js = {}
+            raw = None
             now = time.time()
             nxt = self.fifo[0]
+            ttl = int(self.cfg['ttl'])
             key = '%s/pods/%s' % (self.cfg['prefix'], nxt['key'])
+            if is_heartbeat(nxt):
+
+                #
+                # - heartbeat : the pod record did not change, just refresh its TTL
+                # - if the key expired in the meantime (e.g the heartbeat spent too long
+                #   in our backlog) persist our copy of the record again right away
+                # - if we have no copy forget about it so that the next heartbeat
+                #   triggers a full resend
+                #
+                try:
+                    self.client.refresh(key, ttl=ttl)
+                    metrics.incr('heartbeat_received,tier=kontrol')
+                    logger.debug('%s : heartbeat from %s' % (self.path, nxt['key']))
+
+                except KeyNotFound:
+                    record = records[nxt['key']]
+                    if record and record['hash'] == nxt['hash']:
+                        logger.debug('%s : heartbeat from %s but no record (expired ?), restoring it' % (self.path, nxt['key']))
+                        metrics.incr('keepalive_restored,tier=kontrol')
+                        self.fifo[0] = dict(record)
+                        continue
+
+                    logger.debug('%s : heartbeat from %s but no record (expired ?)' % (self.path, nxt['key']))
+                    records.pop(nxt['key'], None)
+
+                self.fifo.popleft()
+                continue
+
             try:
-                js = json.loads(self.client.read(key).value)
+                raw = self.client.read(key).value
+                js = json.loads(raw)
                 seq = js['seq']
 
-            except EtcdKeyNotFound:
+            except KeyNotFound:
 
                 #
                 # - if the read fails this is the first time that pod is reporting
@@ -75,22 +113,38 @@ class Actor(FSM):
             #
             # - make sure to sort the keys in the json being serialized to etcd
             # - otherwise that could artifically change the MD5 digest
+            # - this is the only place where the keepalive is serialized to json
+            # - compare the serialized forms to detect a change (the incoming state
+            #   is decoded from msgpack and may hold str instead of unicode)
+            # - the record hash is not persisted but the record is kept around with it
+            #   to validate the upcoming heartbeats (and restore it if it expires)
             #
+            digest = nxt.pop('hash', None)
+            record = dict(nxt, hash=digest)
             nxt['seq'] = seq
-            dirty = nxt != js
             js.update(nxt)
-            ttl = int(self.cfg['ttl'])
-            self.client.write(key, json.dumps(js, sort_keys=True), ttl=ttl)
-            logger.debug('%s : keepalive from %s (pod #%d%s)' % (self.path, js['key'], js['seq'], ', dirty' if dirty else ''))
+            serialized = json.dumps(js, sort_keys=True)
+            changed = serialized != raw
+            self.client.write(key, serialized, ttl=ttl)
+            if digest:
+                records[nxt['key']] = record
+            metrics.incr('keepalive_received,tier=kontrol')
+            logger.debug('%s : keepalive from %s (pod #%d%s)' % (self.path, js['key'], js['seq'], ', dirty' if changed else ''))
             self.fifo.popleft()
+            data.dirty |= changed
 
-            #
-            # - if the incoming keepalive differs from what's in etcd update our
-            #   hidden '_dirty' key
-            # - this will automatically wake the leader up
-            #
-            if dirty:
-                self.client.write('%s/_dirty' % self.cfg['prefix'], '')
+        #
+        # - if any keepalive in this batch differs from what's in etcd update our
+        #   hidden '_dirty' key
+        # - this will automatically wake the leader up
+        # - the trigger is kept in data in case we fail halfway through the batch
+        #
+        if data.dirty:
+            self.client.write('%s/_dirty' % self.cfg['prefix'], '')
+            data.dirty = False
+
+        self.status['fifo'] = len(self.fifo)
+        metrics.gauge('keepalive_backlog,tier=kontrol', len(self.fifo))
 
         return 'initial', data, 0.25
 
@@ -100,11 +154,11 @@ class Actor(FSM):
         if req == 'update':
 
             #
-            # - buffer the incoming payload in our fifo
-            # - we'll dequeue it upon the next spin
+            # - buffer the incoming payload(s) in our fifo
+            # - we'll dequeue them upon the next spin
             #
-            assert 'state' in msg, 'invalid message -> "%s" (bug ?)' % msg
-            self.fifo.append(msg['state'])
+            assert 'state' in msg or 'states' in msg, 'invalid message -> "%s" (bug ?)' % msg
+            self.fifo.extend(msg['states'] if 'states' in msg else [msg['state']])
         else:
             super(Actor, self).specialized(msg)
         
@@ -124,23 +178,23 @@ class Actor(FSM):
                 logger.debug('%s : counter @ %d' % (self.path, nxt))
                 return nxt
 
-            except AssertionError:
+            except (AssertionError, CompareFailed):
                 
                 #
-                # - the CAS assert clause failed
+                # - the CAS failed (another party updated the counter in between)
                 # - just ignore and spin
                 #
                 pass
 
-            except EtcdKeyNotFound:
+            except KeyNotFound:
 
                 #
                 # - the sequence key does not exist yet
                 # - attempt to initialize it to -1 (so that the first returned value is 0)
-                # - that could fail on a EtcdAlreadyExist depending on timing
+                # - that could fail on a AlreadyExists depending on timing
                 #
                 try:
                     self.client.write(key, -1, prevExist=False)
-                except EtcdAlreadyExist:
+                except AlreadyExists:
                     pass
                 
@@ -0,0 +1,325 @@
+import argparse
+import gevent
+import heapq
+import json
+import logging
+import os
+import resource
+import sys
+import time
+
+from kontrol.keepalive import acknowledged, assemble, due, track
+from logging import INFO, WARNING
+from logging.config import fileConfig
+from multiprocessing import Process, Queue
+from os.path import dirname
+from random import sample
+
+
+#: our ochopod logger
+logger = logging.getLogger('kontrol')
+
+#: namespace and application label used by the simulated cluster
+NAMESPACE, APP = 'simulator', 'sim'
+
+
+class Slave(object):
+
+    """
+    Virtual slave mimicking the keepalive actor against one single master : it sends its
+    full pod record until the master acknowledges it, then heartbeats. The record assembly,
+    scheduling and acknowledgement logic are the ones of the real thing.
+    """
+
+    def __init__(self, cfg, n, ttl):
+
+        self.cfg = dict(cfg, id='pod-%d' % n, ip='10.%d.%d.%d' % (n >> 16 & 255, n >> 8 & 255, n & 255))
+        self.dead = False
+        self.key = 'v%d' % n
+        self.n = n
+        self.ttl = ttl
+        self.restart(None)
+
+    @property
+    def next(self):
+        return self.target.next
+
+    def restart(self, when):
+
+        #
+        # - a new nonce changes the record and therefore the MD5 digest
+        # - just like a new keepalive actor the first ping is randomized unless
+        #   we want it right away
+        #
+        self.dead = False
+        self.nonce = os.urandom(8).encode('hex')
+        self.js, self.beat = assemble(self.cfg, self.key, self.nonce, {})
+        self.target = track('master', self.ttl, time.time())
+        if when is not None:
+            self.target.next = when
+
+    def fail(self, now):
+
+        #
+        # - stop pinging long enough for the record to expire, then come back
+        #
+        self.dead = True
+        self.target.next = now + self.ttl * 2
+
+    def due(self, now):
+        return due(self.target, self.ttl, self.js['hash'], now)
+
+    def payload(self):
+
+        #
+        # - hand over a copy of the record, just like zerorpc would
+        #
+        return dict(self.js) if self.target.acked != self.js['hash'] else self.beat
+
+    def ack(self, now, reply):
+
+        #
+        # - turn the batch reply into the one a single ping() would get
+        #
+        acknowledged(self.target, self.ttl, self.js['hash'], {'load': reply['load'], 'resend': self.key in reply['resend']}, now)
+
+
+def render(MD5, PODS, STATE):
+
+    """
+    Trivial python callback used by the simulated master.
+    """
+
+    return {'pods': len(PODS)}
+
+
+def _simulate(args, pods, out):
+
+    #
+    # - configure a master running against the in-memory store and flushing its
+    #   metrics in memory
+    # - the python callback runs in its own child process like any plugin
+    # - the script actor is only needed to serve invoke() requests
+    #
+    os.environ.update(
+    {
+        'NAMESPACE': NAMESPACE,
+        'KONTROL_ANNOTATIONS': '{}',
+        'KONTROL_CALLBACK': 'kontrol.simulator:render',
+        'KONTROL_DAMPER': str(args.damper),
+        'KONTROL_ETCD': 'memory',
+        'KONTROL_FOVER': str(args.fover),
+        'KONTROL_ID': 'master',
+        'KONTROL_IP': '127.0.0.1',
+        'KONTROL_LABELS': json.dumps({'app': APP, 'role': 'master'}),
+        'KONTROL_METRICS': 'memory://',
+        'KONTROL_MODE': 'master',
+        'KONTROL_TTL': str(args.ttl)
+    })
+
+    from kontrol import metrics, store
+    from kontrol.fsm import shutdown, statuses
+    from kontrol.main import API, BATCH, actors, incoming
+    from kontrol.script import Actor as Script
+
+    api = API()
+    if args.invoke:
+        actors['script'] = Script.start({})
+
+    mem = store.connect({'etcd': 'memory'})
+    leader = statuses[actors['leader'].actor_urn]
+    digest = '/kontrol/%s/%s/digest' % (NAMESPACE, APP)
+
+    cfg = {'labels': {'app': APP, 'role': 'slave'}}
+    slaves = [Slave(cfg, n, args.ttl) for n in range(pods)]
+    heap = [(slave.next, slave.n) for slave in slaves]
+    heapq.heapify(heap)
+
+    #
+    # - warm up for one TTL so that all the pods registered and the leader settled
+    # - then measure for the specified duration
+    #
+    tick = time.time()
+    start = tick + args.ttl
+    deadline = start + args.duration
+    last = None
+    md5s = {}
+    changes = []
+    pending = []
+    lapses = {'md5': [], 'callback': [], 'invoke': [], 'stall': []}
+    sent = backlog = churned = 0
+    counts = None
+    while time.time() < deadline:
+
+        now = time.time()
+        if counts is None and now >= start:
+            counts = dict(mem.counts)
+            sent = backlog = 0
+            metrics.flush()
+            metrics.registry.sink.lines[:] = []
+            if args.invoke:
+                gevent.spawn(_invoke, api, args.invoke, lapses['invoke'])
+
+        #
+        # - churn : restart a fraction of the pods (new nonce), fail a fraction of them
+        #   (their record expires and they come back later on)
+        # - every change is timestamped until the resulting MD5 digest is observed
+        #
+        if now >= start and now - tick >= 1.0:
+            tick = now
+            for n in sample(range(pods), int(pods * args.churn)):
+                if not slaves[n].dead:
+                    slaves[n].restart(now)
+                    heapq.heappush(heap, (now, n))
+                    changes.append(now)
+                    churned += 1
+
+            for n in sample(range(pods), int(pods * args.failures)):
+                if not slaves[n].dead:
+                    slaves[n].fail(now)
+                    heapq.heappush(heap, (slaves[n].next, n))
+                    changes.append(now)
+                    churned += 1
+
+        #
+        # - ping whatever is due in batches, just like a relay would
+        # - stale heap entries (rescheduled pods) are skipped
+        # - heartbeats held off by a loaded master are rescheduled
+        #
+        ready = []
+        held = []
+        while heap and heap[0][0] <= now:
+            when, n = heapq.heappop(heap)
+            slave = slaves[n]
+            if when != slave.next:
+                continue
+
+            if slave.dead:
+                slave.restart(now)
+                changes.append(now)
+
+            if slave.due(now):
+                ready.append(slave)
+            else:
+                held.append(slave)
+
+        for slave in held:
+            heapq.heappush(heap, (slave.next, slave.n))
+
+        for i in range(0, len(ready), BATCH):
+            chunk = ready[i:i + BATCH]
+            reply = api.ping_batch([slave.payload() for slave in chunk])
+            for slave in chunk:
+                slave.ack(now, reply)
+                heapq.heappush(heap, (slave.next, slave.n))
+
+        sent += len(ready)
+        backlog = max(backlog, len(incoming))
+
+        #
+        # - track how long it takes for changes to be reflected in the leader MD5 digest
+        #   and then for the callback to run against it
+        #
+        md5 = leader['md5']
+        if md5 != last:
+            last = md5
+            md5s[md5] = len(md5s)
+            if now >= start:
+                lapses['md5'] += [now - t for t in changes]
+                pending += [(t, md5s[md5]) for t in changes]
+            changes = []
+
+        node = mem.keys.get(digest)
+        if node and node.value in md5s:
+            applied = md5s[node.value]
+            lapses['callback'] += [now - t for t, index in pending if index <= applied]
+            pending = [(t, index) for t, index in pending if index > applied]
+
+        #
+        # - yield to the hub (which also runs the RPC requests such as invoke())
+        # - whatever we slept on top of the requested delay is time the hub was
+        #   unable to serve anything
+        #
+        before = time.time()
+        gevent.sleep(0.01)
+        if now >= start:
+            lapses['stall'].append(time.time() - before - 0.01)
+
+    #
+    # - gather our metrics and the store operation counts
+    #
+    metrics.flush()
+    totals = {}
+    for line in metrics.registry.sink.lines:
+        key, value = line.split(':', 1)
+        value, kind = value.split('|', 1)
+        if kind == 'c':
+            name = key.split(',')[0]
+            totals[name] = totals.get(name, 0) + int(value)
+
+    def _percentiles(samples, scale=1):
+        samples = sorted(samples)
+        return [round(samples[int(len(samples) * q)] * scale, 2) if samples else None for q in (0.5, 0.99)]
+
+    ops = {op: count - (counts or {}).get(op, 0) for op, count in mem.counts.items()}
+    out.put(
+    {
+        'pods': pods,
+        'changes': churned,
+        'sent/s': round(sent / float(args.duration), 1),
+        'ingested/s': round((totals.get('keepalive_received', 0) + totals.get('heartbeat_received', 0)) / float(args.duration), 1),
+        'max backlog': backlog,
+        'md5 lapse p50/p99': _percentiles(lapses['md5']),
+        'callback lapse p50/p99': _percentiles(lapses['callback']),
+        'callback runs': totals.get('callback_invoked', 0),
+        'callback superseded': totals.get('callback_superseded', 0),
+        'changes never applied': len(pending) + len(changes),
+        'hub stall p50/p99/max (ms)': _percentiles(lapses['stall'], 1000) + [round(max(lapses['stall'] or [0]) * 1000, 2)],
+        'invoke lapse': round(lapses['invoke'][0], 2) if lapses['invoke'] else None,
+        'store ops/s': {op: round(count / float(args.duration), 1) for op, count in sorted(ops.items())},
+        'max rss (MB)': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+    })
+
+    for actor in actors.values():
+        shutdown(actor)
+
+
+def _invoke(api, seconds, out):
+
+    #
+    # - run a script through the RPC API just like a master would and time it
+    #
+    tick = time.time()
+    if api.invoke({'cmd': 'sleep %d' % seconds, 'timeout': seconds + 10}) is not None:
+        out.append(time.time() - tick)
+
+
+def go():
+
+    """
+    Entry point for the kontrol simulator. The real master code (API plus the leader, sequence
+    and callback actors) runs against the in-memory store and is driven by virtual slaves.
+    Each cluster size is simulated in its own process.
+    """
+    parser = argparse.ArgumentParser(description='kontrol simulator', prefix_chars='-')
+    parser.add_argument('-p', '--pods', type=str, default='100,1000,10000', help='comma separated cluster sizes')
+    parser.add_argument('-t', '--duration', type=int, default=60, help='measurement duration in seconds')
+    parser.add_argument('-c', '--churn', type=float, default=0.01, help='fraction of pods restarting every second')
+    parser.add_argument('-f', '--failures', type=float, default=0.0, help='fraction of pods failing every second')
+    parser.add_argument('--ttl', type=int, default=10, help='pod keepalive cutoff in seconds')
+    parser.add_argument('--damper', type=int, default=1, help='callback damper in seconds')
+    parser.add_argument('--fover', type=int, default=10, help='master fail-over delay in seconds')
+    parser.add_argument('--invoke', type=int, default=0, help='duration in seconds of a script invoked via RPC while measuring')
+    parser.add_argument('-d', '--debug', action='store_true', help='kontrol logging on')
+    args = parser.parse_args()
+
+    fileConfig('%s/log.cfg' % dirname(__file__), disable_existing_loggers=True)
+    logger.setLevel(INFO if args.debug else WARNING)
+
+    for pods in [int(n) for n in args.pods.split(',')]:
+        out = Queue()
+        child = Process(target=_simulate, args=(args, pods, out))
+        child.start()
+        report = out.get()
+        child.join()
+        print(json.dumps(report, sort_keys=True))
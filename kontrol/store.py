@@ -0,0 +1,714 @@
+import etcd
+import heapq
+import logging
+import time
+import urllib3
+
+from collections import deque
+from contextlib import contextmanager
+from kontrol import metrics
+from threading import Condition, Lock
+from urllib3.util import Retry
+
+#
+# - the etcd v3 backend is optional
+#
+try:
+    import etcd3
+
+    from etcd3 import exceptions
+    from etcd3.events import DeleteEvent
+    from etcd3.exceptions import Etcd3Exception
+
+except ImportError:
+    etcd3 = None
+
+    class Etcd3Exception(Exception):
+        pass
+
+
+#: our ochopod logger
+logger = logging.getLogger('kontrol')
+
+#: maximum number of pooled connections to etcd for short requests
+POOL = 8
+
+#: timeout in seconds for short requests
+TIMEOUT = 10.0
+
+#: number of past events the in-memory store keeps around for its watches
+HISTORY = 1000
+
+#: shared short request clients, per etcd host
+shared = {}
+
+#: guards the shared clients
+lock = Lock()
+
+
+class StoreError(Exception):
+    pass
+
+
+class KeyNotFound(StoreError):
+
+    def __init__(self, key, index=None):
+        super(KeyNotFound, self).__init__('key %s not found' % key)
+        self.index = index
+
+
+class AlreadyExists(StoreError):
+    pass
+
+
+class CompareFailed(StoreError):
+    pass
+
+
+class IndexCleared(StoreError):
+    pass
+
+
+class Unavailable(StoreError):
+    pass
+
+
+class WatchTimedOut(StoreError):
+    pass
+
+
+class Node(object):
+
+    """
+    Key returned by the store. Directories (e.g recursive reads) hold their children and
+    expose their leaves, a leaf or an empty directory being its own single leaf.
+    """
+
+    def __init__(self, key, value=None, created=None, modified=None, action='get', ttl=None, children=None):
+
+        self.action = action
+        self.children = children
+        self.created = created
+        self.key = key
+        self.modified = modified
+        self.ttl = ttl
+        self.value = value
+
+    @property
+    def leaves(self):
+        if not self.children:
+            return [self]
+        return [leaf for child in self.children for leaf in child.leaves]
+
+
+class Store(object):
+
+    """
+    Coordination store interface covering what kontrol needs : reads (optionally recursive),
+    writes with an optional TTL, in-order keys and compare-and-swap conditions, TTL refreshes,
+    deletes and single key watches. Values are always strings.
+    """
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def read(self, key, recursive=False):
+        raise NotImplementedError
+
+    def refresh(self, key, ttl):
+        raise NotImplementedError
+
+    def watch(self, key, index=None, timeout=None):
+
+        """
+        Blocks until the key is updated, starting at the specified index if any.
+
+        :type key: str
+        :param key: the key to watch
+        :type index: int
+        :param index: optional index to start from
+        :type timeout: float
+        :param timeout: optional timeout in seconds, :class:`WatchTimedOut` is raised upon expiry
+        :rtype: :class:`Node`
+        """
+        raise NotImplementedError
+
+    def write(self, key, value, ttl=None, append=False, prevValue=None, prevExist=None):
+
+        """
+        Writes a key.
+
+        :type key: str
+        :param key: the key to write, or its directory if *append* is set
+        :type value: str
+        :param value: the value to write
+        :type ttl: int
+        :param ttl: optional TTL in seconds
+        :type append: bool
+        :param append: if true create a new in-order key under *key*
+        :type prevValue: str
+        :param prevValue: if specified only write if the current value matches
+        :type prevExist: bool
+        :param prevExist: if specified only write if the key existence matches
+        :rtype: :class:`Node`
+        """
+        raise NotImplementedError
+
+
+class Etcd(Store):
+
+    """
+    Etcd v2 store wrapping python-etcd with our own connection pool, timeout and retry policy
+    (independently from the urllib3 defaults). Connection failures are retried once while
+    read timeouts are never retried, which means a watch blocks for exactly the specified
+    timeout. The latency of each operation is recorded as a metric tagged by operation.
+
+    Short requests are meant to go through the client shared by all the actors while each
+    long-polling watch should use its own dedicated client (e.g its own connection) so that
+    it can never starve the short requests.
+    """
+
+    def __init__(self, host, port=2379, pool=POOL, timeout=TIMEOUT):
+
+        self.client = etcd.Client(host=host, port=port, read_timeout=timeout, per_host_pool_size=pool)
+        self.client.http = urllib3.PoolManager(
+            num_pools=1,
+            maxsize=pool,
+            block=True,
+            timeout=timeout,
+            retries=Retry(total=1, read=False, redirect=0))
+
+    def delete(self, key):
+        with self._timed('delete'):
+            return _node(self.client.delete(key))
+
+    def read(self, key, recursive=False):
+        with self._timed('read'):
+            return _node(self.client.read(key, recursive=recursive))
+
+    def refresh(self, key, ttl):
+        with self._timed('refresh'):
+            return _node(self.client.refresh(key, ttl=ttl))
+
+    def watch(self, key, index=None, timeout=None):
+
+        #
+        # - no latency metric here as watches block until something happens
+        #
+        with _mapped():
+            return _node(self.client.watch(key, index=index, timeout=timeout))
+
+    def write(self, key, value, ttl=None, append=False, prevValue=None, prevExist=None):
+
+        kwargs = {}
+        if prevValue is not None:
+            kwargs['prevValue'] = prevValue
+        if prevExist is not None:
+            kwargs['prevExist'] = prevExist
+
+        with self._timed('write'):
+            return _node(self.client.write(key, value, ttl=ttl, append=append, **kwargs))
+
+    @contextmanager
+    def _timed(self, op):
+        tick = time.time()
+        try:
+            with _mapped():
+                yield
+
+        finally:
+            metrics.timing('etcd_latency,op=%s,tier=kontrol' % op, (time.time() - tick) * 1000)
+
+
+class Memory(Store):
+
+    """
+    Fully in-memory store with TTLs and watches, meant for benchmarks and simulations
+    running on a single box. Keys expire lazily (upon the next operation or while a watch
+    is pending). The last events are kept around so that watches can resume from a given
+    index, just like with etcd. Operations are counted per type.
+
+    Expiry deadlines are kept in a heap and each directory indexes its children, which
+    means no operation ever scans the whole keyspace.
+    """
+
+    def __init__(self, history=HISTORY):
+
+        self.cond = Condition(Lock())
+        self.counts = {}
+        self.deadlines = []
+        self.dirs = {}
+        self.events = deque(maxlen=history)
+        self.index = 0
+        self.keys = {}
+
+    def delete(self, key):
+        with self.cond:
+            self._expire('delete')
+            if key not in self.keys:
+                raise KeyNotFound(key, self.index)
+
+            node = self.keys.pop(key)
+            self._unlink(key)
+            return self._event(Node(key, created=node.created, action='delete'))
+
+    def read(self, key, recursive=False):
+        with self.cond:
+            self._expire('read')
+            if key in self.keys:
+                return self._copy(self.keys[key])
+
+            #
+            # - treat the key as a directory
+            # - a recursive read returns all the leaves below it, otherwise only return
+            #   its direct children
+            #
+            path = key.rstrip('/')
+            if path not in self.dirs:
+                raise KeyNotFound(key, self.index)
+
+            below = self.dirs[path]
+            if recursive:
+                below = []
+                pending = [path]
+                while pending:
+                    for k in self.dirs[pending.pop()]:
+                        if k in self.keys:
+                            below.append(k)
+                        if k in self.dirs:
+                            pending.append(k)
+
+            return Node(key, modified=self.index, children=[self._copy(self.keys[k]) if k in self.keys else Node(k) for k in sorted(below)])
+
+    def refresh(self, key, ttl):
+
+        #
+        # - just like etcd refreshing a TTL does not notify the watches
+        #
+        with self.cond:
+            self._expire('refresh')
+            if key not in self.keys:
+                raise KeyNotFound(key, self.index)
+
+            node = self.keys[key]
+            self.index += 1
+            node.action = 'update'
+            node.modified = self.index
+            node.ttl = time.time() + ttl
+            heapq.heappush(self.deadlines, (node.ttl, key))
+            return self._copy(node)
+
+    def watch(self, key, index=None, timeout=None):
+        deadline = time.time() + timeout if timeout else None
+        with self.cond:
+            self._expire('watch')
+            start = index if index else self.index + 1
+            while 1:
+                self._expire()
+                if len(self.events) == self.events.maxlen and start < self.events[0].modified:
+                    raise IndexCleared('index %d cleared' % start)
+
+                for event in self.events:
+                    if event.key == key and event.modified >= start:
+                        return self._copy(event)
+
+                #
+                # - wake up periodically to expire keys
+                #
+                left = deadline - time.time() if deadline else 0.25
+                if left <= 0:
+                    raise WatchTimedOut('watch on %s timed out' % key)
+
+                self.cond.wait(min(left, 0.25))
+
+    def write(self, key, value, ttl=None, append=False, prevValue=None, prevExist=None):
+        with self.cond:
+            self._expire('write')
+            if append:
+                key = '%s/%020d' % (key.rstrip('/'), self.index + 1)
+
+            cur = self.keys.get(key)
+            if prevExist is False and cur:
+                raise AlreadyExists('key %s already exists' % key)
+
+            if (prevExist or prevValue is not None) and not cur:
+                raise KeyNotFound(key, self.index)
+
+            if prevValue is not None and cur.value != str(prevValue):
+                raise CompareFailed('key %s compare failed (%s != %s)' % (key, cur.value, prevValue))
+
+            node = Node(key,
+                value=str(value),
+                created=cur.created if cur else self.index + 1,
+                action='create' if append else ('compareAndSwap' if prevValue is not None else 'set'),
+                ttl=time.time() + ttl if ttl else None)
+
+            self.keys[key] = node
+            if not cur:
+                self._link(key)
+            if node.ttl:
+                heapq.heappush(self.deadlines, (node.ttl, key))
+            return self._event(node)
+
+    def _copy(self, node):
+
+        #
+        # - hand out copies with the remaining TTL, the stored ones hold their expiry time
+        #
+        ttl = int(node.ttl - time.time()) if node.ttl else None
+        return Node(node.key, node.value, node.created, node.modified, node.action, ttl)
+
+    def _event(self, node):
+
+        #
+        # - bump the index, record the event and wake the watches up
+        #
+        self.index += 1
+        node.modified = self.index
+        self.events.append(self._copy(node))
+        self.cond.notify_all()
+        return self._copy(node)
+
+    def _expire(self, op=None):
+
+        #
+        # - count the operation (for benchmarking purposes)
+        # - pop whatever deadline passed and drop the key if it still holds it (a deadline
+        #   is stale once the key got refreshed, rewritten or deleted)
+        #
+        if op:
+            self.counts[op] = self.counts.get(op, 0) + 1
+
+        now = time.time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            ttl, key = heapq.heappop(self.deadlines)
+            node = self.keys.get(key)
+            if node and node.ttl == ttl:
+                del self.keys[key]
+                self._unlink(key)
+                self._event(Node(key, created=node.created, action='expire'))
+
+    def _link(self, key):
+
+        #
+        # - add a new key to its parent directory, creating the missing ones
+        #
+        while key:
+            parent = key.rpartition('/')[0]
+            known = parent in self.dirs
+            self.dirs.setdefault(parent, set()).add(key)
+            if known:
+                break
+
+            key = parent
+
+    def _unlink(self, key):
+
+        #
+        # - remove a deleted key from its parent directory, dropping the ones left empty
+        #
+        while key and key not in self.keys and key not in self.dirs:
+            parent = key.rpartition('/')[0]
+            self.dirs[parent].discard(key)
+            if not self.dirs[parent]:
+                del self.dirs[parent]
+
+            key = parent
+
+
+class Etcd3(Store):
+
+    """
+    Etcd v3 store relying on leases rather than per-key TTLs. Each key written with a TTL
+    (e.g each pod record or lock key) gets its own lease which is then reused by subsequent
+    writes. Refreshing the TTL only sends a keepalive on the lease instead of rewriting the
+    value, adopting whatever lease the key is attached to (another master may have written
+    it last). In-order keys are emulated using a timestamp based name created only if absent
+    and ordered by their creation revision. Modification indices map onto revisions.
+
+    This backend requires the optional etcd3 package (e.g pip install kontrol[etcd3]).
+    """
+
+    def __init__(self, host, port=2379, timeout=TIMEOUT):
+
+        assert etcd3, 'the etcd3 package is not installed (pip install kontrol[etcd3])'
+        self.client = etcd3.client(host=host, port=port, timeout=timeout)
+        self.leases = {}
+        self.lock = Lock()
+        self.ops = self.client.transactions
+
+    def delete(self, key):
+        with self._timed('delete'):
+            if not self.client.delete(key):
+                raise KeyNotFound(key)
+
+            with self.lock:
+                self.leases.pop(key, None)
+
+            return Node(key, action='delete')
+
+    def read(self, key, recursive=False):
+        with self._timed('read'):
+            res = self.client.get_response(key)
+            if res.count:
+                kv = res.kvs[0]
+                return Node(key, kv.value, kv.create_revision, kv.mod_revision)
+
+            #
+            # - treat the key as a directory and return all the keys below it
+            #
+            below = self.client.get_prefix(key.rstrip('/') + '/')
+            children = [Node(meta.key, value, meta.create_revision, meta.mod_revision) for value, meta in below]
+            if not children:
+                raise KeyNotFound(key, res.header.revision)
+
+            return Node(key, modified=res.header.revision, children=children)
+
+    def refresh(self, key, ttl):
+        with self._timed('refresh'):
+
+            #
+            # - lookup the lease the key is currently attached to
+            # - each master writes the pod records with its own lease : whoever wrote last
+            #   owns the key, in which case the lease we cached is stale and only kept
+            #   alive for nothing, revoke it
+            # - then adopt the lease holding the key so that it stays alive as long as any
+            #   master gets keepalives (even if the one that wrote it last died)
+            #
+            value, meta = self.client.get(key)
+            with self.lock:
+                lease, granted = self.leases.get(key, (None, None))
+                if meta is None or meta.lease_id != lease:
+                    self.leases.pop(key, None)
+
+            if meta is None:
+                if lease:
+                    self._revoke(lease)
+                raise KeyNotFound(key)
+
+            if meta.lease_id != lease:
+                if lease:
+                    self._revoke(lease)
+
+                lease = meta.lease_id
+                granted = self.client.get_lease_info(lease).grantedTTL if lease else None
+                if lease:
+                    with self.lock:
+                        self.leases[key] = (lease, granted)
+
+            #
+            # - leases have a fixed TTL : move the key over to a new lease if the
+            #   requested TTL differs (this only happens once per key, e.g the leader lock)
+            # - otherwise just send a keepalive, a lease that expired is reported with a
+            #   null TTL
+            # - please note the keepalive RPC is streaming only : each refresh opens a short
+            #   lived stream on the shared channel (not a new connection)
+            #
+            if granted != ttl:
+                return self.write(key, value, ttl=ttl)
+
+            responses = list(self.client.refresh_lease(lease))
+            if not responses or responses[0].TTL <= 0:
+                with self.lock:
+                    self.leases.pop(key, None)
+                raise KeyNotFound(key)
+
+            return Node(key, action='update', ttl=responses[0].TTL)
+
+    def watch(self, key, index=None, timeout=None):
+        with _mapped():
+            event = self.client.watch_once(key, timeout=timeout, start_revision=index)
+            deleted = isinstance(event, DeleteEvent)
+            return Node(key,
+                value=None if deleted else event.value,
+                created=event.create_revision,
+                modified=event.mod_revision,
+                action='delete' if deleted else 'set')
+
+    def write(self, key, value, ttl=None, append=False, prevValue=None, prevExist=None):
+        with self._timed('write'):
+
+            compare = []
+            value = str(value)
+            if append:
+
+                #
+                # - emulate in-order keys by creating a new key named after the current time
+                # - the creation only succeeds if the key does not exist yet
+                #
+                key = '%s/%020d' % (key.rstrip('/'), int(time.time() * 1000000))
+                prevExist = False
+
+            if prevValue is not None:
+                compare.append(self.ops.value(key) == str(prevValue))
+            if prevExist is not None:
+                compare.append(self.ops.version(key) > 0 if prevExist else self.ops.version(key) == 0)
+
+            #
+            # - reuse the lease attached to the key as long as its TTL matches, sending it
+            #   a keepalive since writing the key does not extend its life
+            # - a lease that already expired is forgotten and replaced
+            # - otherwise grant a new one and revoke the old one once the key moved over
+            #
+            lease, previous = None, None
+            if ttl:
+                with self.lock:
+                    lease, granted = self.leases.get(key, (None, None))
+
+                if granted == ttl:
+                    responses = list(self.client.refresh_lease(lease))
+                    if not responses or responses[0].TTL <= 0:
+                        with self.lock:
+                            self.leases.pop(key, None)
+                        lease, granted = None, None
+
+                if granted != ttl:
+                    previous, lease = lease, self.client.lease(int(ttl)).id
+
+            try:
+                ok, responses = self.client.transaction(
+                    compare=compare,
+                    success=[self.ops.put(key, value, lease=lease)],
+                    failure=[])
+
+            except Exception:
+
+                #
+                # - the lease may have expired in between : forget it so that the next
+                #   attempt grants a new one instead of failing over and over
+                #
+                with self.lock:
+                    self.leases.pop(key, None)
+                raise
+
+            if not ok:
+                if lease and lease != previous:
+                    self.client.revoke_lease(lease)
+
+                _, meta = self.client.get(key)
+                if prevExist is False:
+                    raise AlreadyExists('key %s already exists' % key)
+                if meta is None:
+                    raise KeyNotFound(key)
+                raise CompareFailed('key %s compare failed' % key)
+
+            if ttl:
+                with self.lock:
+                    self.leases[key] = (lease, ttl)
+
+                if previous and previous != lease:
+                    self.client.revoke_lease(previous)
+
+            revision = responses[0].response_put.header.revision
+            action = 'create' if append else ('compareAndSwap' if prevValue is not None else 'set')
+            return Node(key, value, revision if append else None, revision, action)
+
+    def _revoke(self, lease):
+
+        #
+        # - best effort : the lease may have expired already
+        #
+        try:
+            self.client.revoke_lease(lease)
+
+        except Exception:
+            pass
+
+    @contextmanager
+    def _timed(self, op):
+        tick = time.time()
+        try:
+            with _mapped():
+                yield
+
+        finally:
+            metrics.timing('etcd_latency,op=%s,tier=kontrol' % op, (time.time() - tick) * 1000)
+
+
+@contextmanager
+def _mapped():
+
+    #
+    # - translate the python-etcd exceptions into ours
+    #
+    try:
+        yield
+
+    except etcd.EtcdKeyNotFound as failure:
+        raise KeyNotFound(failure.payload['cause'] if failure.payload else '?', failure.payload['index'] if failure.payload else None)
+
+    except etcd.EtcdAlreadyExist as failure:
+        raise AlreadyExists(str(failure))
+
+    except etcd.EtcdCompareFailed as failure:
+        raise CompareFailed(str(failure))
+
+    except etcd.EtcdEventIndexCleared as failure:
+        raise IndexCleared(str(failure))
+
+    except etcd.EtcdWatchTimedOut as failure:
+        raise WatchTimedOut(str(failure))
+
+    except etcd.EtcdConnectionFailed as failure:
+        raise Unavailable(str(failure))
+
+    except Etcd3Exception as failure:
+
+        #
+        # - the etcd3 exceptions (if the package is installed)
+        #
+        if isinstance(failure, exceptions.WatchTimedOut):
+            raise WatchTimedOut('watch timed out')
+        if isinstance(failure, exceptions.RevisionCompactedError):
+            raise IndexCleared(str(failure))
+        if isinstance(failure, exceptions.PreconditionFailedError):
+            raise CompareFailed(str(failure))
+        raise Unavailable(str(failure))
+
+
+def _node(res):
+
+    #
+    # - convert a python-etcd result into a node
+    #
+    children = [_node(etcd.EtcdResult(None, child)) for child in res._children] if res.dir and res._children else None
+    return Node(res.key, res.value, res.createdIndex, res.modifiedIndex, res.action, res.ttl, children)
+
+
+def connect(cfg, watch=False):
+
+    """
+    Returns the store specified by our configuration, either the etcd v2 host, *etcd3://<host>*
+    for the etcd v3 backend or *memory* for a process-wide in-memory store. The client used for
+    short requests is shared by all the actors.
+
+    :type cfg: dict
+    :param cfg: kontrol configuration
+    :type watch: bool
+    :param watch: if true return a new etcd client with one dedicated connection for watching
+    :rtype: :class:`Store`
+    """
+
+    host = cfg['etcd']
+    with lock:
+        if host == 'memory':
+            if host not in shared:
+                shared[host] = Memory()
+            return shared[host]
+
+        if host.startswith('etcd3://'):
+
+            #
+            # - the v3 watches are multiplexed over the same grpc channel
+            #
+            if host not in shared:
+                address = host[len('etcd3://'):].split(':')
+                shared[host] = Etcd3(address[0], port=int(address[1]) if len(address) > 1 else 2379)
+            return shared[host]
+
+        if watch:
+            return Etcd(host, pool=1)
+
+        if host not in shared:
+            shared[host] = Etcd(host)
+        return shared[host]
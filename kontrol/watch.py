@@ -0,0 +1,134 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+
+from os.path import basename, dirname
+from threading import Thread
+
+
+#: our ochopod logger
+logger = logging.getLogger('kontrol')
+
+#: inotify flags we care about (IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE)
+MASK = 0x00000002 | 0x00000004 | 0x00000008 | 0x00000080 | 0x00000100
+
+
+def _inotify():
+
+    #
+    # - bind inotify_init() and inotify_add_watch() from the libc
+    # - return None if not available (e.g not running on linux)
+    #
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        return libc if hasattr(libc, 'inotify_init') and hasattr(libc, 'inotify_add_watch') else None
+
+    except OSError:
+        return None
+
+
+class Watcher(Thread):
+
+    """
+    Daemon thread tracking updates to a given file and invoking a callback whenever it
+    is written to or atomically replaced (e.g renamed over). The parent directory is
+    monitored via inotify, and we revert to polling the file if inotify is not available.
+    Bursts of updates are debounced : the callback only fires once the file has been
+    quiet for a little while.
+    """
+
+    def __init__(self, path, callback, debounce=0.1, spin=0.25):
+        super(Watcher, self).__init__()
+
+        self.callback = callback
+        self.daemon = True
+        self.debounce = debounce
+        self.path = path
+        self.spin = spin
+        self.terminate = 0
+
+    def stop(self):
+        self.terminate = 1
+
+    def run(self):
+
+        libc = _inotify()
+        fd = libc.inotify_init() if libc else -1
+        if fd < 0 or libc.inotify_add_watch(fd, dirname(os.path.abspath(self.path)), MASK) < 0:
+
+            #
+            # - release the inotify instance if only the watch failed
+            #
+            if fd >= 0:
+                os.close(fd)
+
+            logger.debug('watcher : inotify not available, polling %s' % self.path)
+            self._poll()
+        else:
+            logger.debug('watcher : using inotify on %s' % self.path)
+            try:
+                self._notify(fd)
+            finally:
+                os.close(fd)
+
+    def _notify(self, fd):
+
+        name = basename(self.path)
+        pending = False
+        while not self.terminate:
+
+            #
+            # - wait for events, use a short timeout if we have an update pending
+            #   to implement the debouncing
+            # - once nothing happened for a while fire the callback
+            #
+            ready, _, _ = select.select([fd], [], [], self.debounce if pending else self.spin)
+            if not ready:
+                if pending:
+                    pending = False
+                    self.callback()
+                continue
+
+            #
+            # - parse the inotify_event structs
+            # - only consider the ones matching our file
+            #
+            buf = os.read(fd, 4096)
+            while len(buf) >= 16:
+                _, _, _, size = struct.unpack('iIII', buf[:16])
+                if buf[16:16 + size].rstrip('\0') == name:
+                    pending = True
+                buf = buf[16 + size:]
+
+    def _poll(self):
+
+        last = self._stat()
+        pending = 0
+        while not self.terminate:
+
+            #
+            # - fallback : stat the file periodically and compare its inode, size and
+            #   modification time
+            # - spin faster while an update is pending to implement the debouncing
+            #
+            time.sleep(self.debounce if pending else self.spin)
+            cur = self._stat()
+            if cur != last:
+                last = cur
+                pending = time.time()
+
+            elif pending and time.time() - pending >= self.debounce:
+                pending = 0
+                self.callback()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return st.st_ino, st.st_size, st.st_mtime
+
+        except OSError:
+            return None
@@ -12,16 +12,23 @@ setup(
     name='kontrol',
     version='1.0.0',
     packages=['automaton', 'kontrol'],
+    #
+    # - msgpack 1.0+ dropped its C extension on python 2 and falls back to a pure python
+    #   implementation, which is slower than json at encoding our RPC payloads
+    #
     install_requires=
     [
-        'jinja2>=2.9.6',
         'jsonschema>=2.6.0',
+        'msgpack>=0.5.2,<1.0',
         'pykka>=1.2.0',
         'python-etcd>=0.4.3',
         'pyyaml>=3.12',
-        'statsd>=2.0.0',
         'zerorpc>=0.6.1'
     ],
+    extras_require=
+    {
+        'etcd3': ['etcd3>=0.11.1']
+    },
     package_data={
         'kontrol':
             [
@@ -37,7 +44,8 @@ setup(
             'console_scripts':
                 [
                     'automaton = automaton.main:go',
-                    'kontrol = kontrol.main:go'
+                    'kontrol = kontrol.main:go',
+                    'kontrol-simulator = kontrol.simulator:go'
                 ]
         },
 )
\ No newline at end of file